@@ -0,0 +1,127 @@
+import threading
+
+# Degradation levels, in the order they are reached as load rises
+FULL = 'full'
+SKIP_ENSEMBLE = 'skip_ensemble'
+SKIP_HEATMAP = 'skip_heatmap'
+LEVELS = (FULL, SKIP_ENSEMBLE, SKIP_HEATMAP)
+
+
+class Overloaded(Exception):
+    """The request was not admitted; retry after ``retry_after`` seconds."""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    """An admitted request; releases its slot when used as a context manager exits."""
+
+    def __init__(self, controller, client, level):
+        self.controller = controller
+        self.client = client
+        self.level = level
+        self._released = False
+
+    @property
+    def skip_ensemble(self):
+        return self.level in (SKIP_ENSEMBLE, SKIP_HEATMAP)
+
+    @property
+    def skip_heatmap(self):
+        return self.level == SKIP_HEATMAP
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self.client)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """Bounds the requests being processed, overall and per client.
+
+    A request is refused (:class:`Overloaded`) when ``max_in_flight``
+    requests are already being processed or its client already has
+    ``max_per_client`` of them. Admitted requests are degraded as the
+    number in flight grows: from ``skip_ensemble_at`` only the first model
+    of a plan runs, from ``skip_heatmap_at`` Grad-CAM is skipped too. A
+    limit of 0 disables it.
+    """
+
+    def __init__(self, max_in_flight=32, max_per_client=8, skip_ensemble_at=16, skip_heatmap_at=24,
+                 retry_after_seconds=1):
+        self.max_in_flight = max_in_flight
+        self.max_per_client = max_per_client
+        self.skip_ensemble_at = skip_ensemble_at
+        self.skip_heatmap_at = skip_heatmap_at
+        self.retry_after = retry_after_seconds
+        self._in_flight = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.counters = dict({level: 0 for level in LEVELS}, rejected=0, rejected_client=0)
+
+    def _level(self, in_flight):
+        if self.skip_heatmap_at and in_flight >= self.skip_heatmap_at:
+            return SKIP_HEATMAP
+        if self.skip_ensemble_at and in_flight >= self.skip_ensemble_at:
+            return SKIP_ENSEMBLE
+        return FULL
+
+    def admit(self, client):
+        """Return a :class:`Ticket` for ``client`` or raise :class:`Overloaded`."""
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                self.counters['rejected'] += 1
+                raise Overloaded(f"{self._in_flight} requests are already being processed",
+                                 self.retry_after, 'rejected')
+            client_in_flight = self._clients.get(client, 0)
+            if self.max_per_client and client_in_flight >= self.max_per_client:
+                self.counters['rejected_client'] += 1
+                raise Overloaded(f"Client already has {client_in_flight} requests being processed",
+                                 self.retry_after, 'rejected_client')
+            # The level is set by the load this request joins
+            level = self._level(self._in_flight)
+            self._in_flight += 1
+            self._clients[client] = client_in_flight + 1
+            self.counters[level] += 1
+            return Ticket(self, client, level)
+
+    def _release(self, client):
+        with self._lock:
+            self._in_flight -= 1
+            remaining = self._clients.get(client, 1) - 1
+            if remaining > 0:
+                self._clients[client] = remaining
+            else:
+                self._clients.pop(client, None)
+
+    def metric_gauges(self):
+        """Requests in flight for /metrics."""
+        yield 'lung_requests_in_flight', {}, self.stats()['in_flight']
+
+    def metric_counters(self):
+        """Admission outcomes since startup for /metrics."""
+        stats = self.stats()
+        for outcome in LEVELS + ('rejected', 'rejected_client'):
+            yield 'lung_admission_events_total', {'outcome': outcome}, stats[outcome]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({
+                'in_flight': self._in_flight,
+                'clients': len(self._clients),
+                'max_in_flight': self.max_in_flight,
+                'max_per_client': self.max_per_client,
+                'skip_ensemble_at': self.skip_ensemble_at,
+                'skip_heatmap_at': self.skip_heatmap_at,
+            })
+            return stats
@@ -1,7 +1,22 @@
-from flask import Flask, request, jsonify, send_from_directory
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from werkzeug.exceptions import NotFound
 import os
+import json
+import tarfile
+import zipfile
+import config
+
+# XLA reads its flags once, when TensorFlow is first imported
+if config.XLA_CACHE_DIR:
+    os.environ['TF_XLA_FLAGS'] = (
+        os.environ.get('TF_XLA_FLAGS', '') + f' --tf_xla_persistent_cache_directory={config.XLA_CACHE_DIR}'
+    ).strip()
+
 from image_processor import ImageProcessor
+from job_manager import JobManager, JobsFull
+from admission import AdmissionController, Overloaded
+from dicom_series import decode_image, open_series
+from metrics import METRICS
 from flask_cors import CORS
 import logging
 import tensorflow as tf
@@ -9,7 +24,7 @@ import subprocess
 import platform
 
 # Configure logging
-logging.basicConfig(level=logging.INFO,
+logging.basicConfig(level=config.LOG_LEVEL,
                    format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -38,6 +53,12 @@ def get_nvidia_gpu_info():
     except (subprocess.CalledProcessError, FileNotFoundError):
         return None
 
+# Thread pools must be sized before TensorFlow creates its runtime
+if config.TF_INTRA_OP_THREADS > 0:
+    tf.config.threading.set_intra_op_parallelism_threads(config.TF_INTRA_OP_THREADS)
+if config.TF_INTER_OP_THREADS > 0:
+    tf.config.threading.set_inter_op_parallelism_threads(config.TF_INTER_OP_THREADS)
+
 # Check for GPU availability and log device information
 physical_devices = tf.config.list_physical_devices()
 gpu_devices = tf.config.list_physical_devices('GPU')
@@ -87,88 +108,179 @@ CORS(app)  # Enable CORS for all routes
 # Initialize the processor
 try:
     processor = ImageProcessor()
-    logger.info("Models loaded successfully")
+    jobs = JobManager(config.JOB_MAX, config.JOB_TTL_S, config.JOB_WORKERS)
+    METRICS.register_gauges(lambda: [('lung_jobs_pending', {}, jobs.stats()['pending'])])
+    admission = AdmissionController(
+        max_in_flight=config.ADMISSION_MAX_IN_FLIGHT,
+        max_per_client=config.ADMISSION_MAX_PER_CLIENT,
+        skip_ensemble_at=config.DEGRADE_ENSEMBLE_AT,
+        skip_heatmap_at=config.DEGRADE_HEATMAP_AT,
+        retry_after_seconds=config.ADMISSION_RETRY_AFTER_S,
+    )
+    METRICS.register_gauges(admission.metric_gauges)
+    METRICS.register_counters(admission.metric_counters)
+    logger.info("Image processor initialized, models load on first use")
 except Exception as e:
     logger.error(f"Failed to initialize ImageProcessor: {str(e)}")
     raise
 
-# Configure upload folder
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Configure uploads (kept in memory, never written to disk)
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'dcm', 'dicom'}
+STUDY_EXTENSIONS = {'dcm', 'dicom', 'zip'}
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+MAX_IMAGE_SIZE = 16 * 1024 * 1024  # 16MB max file size for /predict
+# /predict_batch accepts whole studies, so the request limit is the larger batch limit
+app.config['MAX_CONTENT_LENGTH'] = max(MAX_IMAGE_SIZE, config.BATCH_MAX_UPLOAD_MB * 1024 * 1024)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @app.route('/static/heatmaps/<path:filename>')
 def serve_heatmap(filename):
-    logger.info(f"Serving heatmap: {filename}")
+    store = processor.heatmap_generator.store
+    # Heatmap names are unique and never rewritten, so browsers may keep them
+    max_age = config.HEATMAP_HTTP_MAX_AGE_S
+    if store.mode == 'memory':
+        data = store.get(filename)
+        if data is None:
+            return "File not found", 404
+        response = Response(data, mimetype=store.mime_type(filename))
+        response.headers['Cache-Control'] = f'public, max-age={max_age}, immutable'
+        response.set_etag(filename)
+        return response.make_conditional(request)
+    # Generated overlays first, then the files shipped in static/heatmaps
+    for directory in (store.directory, os.path.join(STATIC_DIR, 'heatmaps')):
+        try:
+            response = send_from_directory(directory, filename, max_age=max_age)
+            response.headers['Cache-Control'] = f'public, max-age={max_age}, immutable'
+            return response
+        except NotFound:
+            pass
+    return "File not found", 404
+
+@app.after_request
+def count_request(response):
+    METRICS.inc('lung_requests_total', endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+def format_result(result):
+    """Format a processor result to match frontend expectations"""
+    response = {
+        'status': 'success',
+        'image_type': result['scan_type'],
+        'disease_type': result['disease'],
+        'disease_probability': result['confidence'],
+        'model_used': result['model_used'],
+        'visualization': result['visualization'],  # This will now be a URL to the heatmap image
+        'visualizations': result.get('visualizations', {}),
+        'all_predictions': result['all_predictions'],
+        'models_run': result['models_run'],
+        'model_timings': result['model_timings'],
+        'cached': result.get('cached', False),
+        'degraded': result.get('degraded', [])
+    }
+    
+    # Add additional fields based on disease type
+    if result['disease'] == 'pneumonia':
+        response['pneumonia_severity'] = 'moderate'  # Placeholder severity
+    elif result['disease'] in ['Adenocarcinoma', 'Large Cell Carcinoma', 'Squamous Cell Carcinoma']:
+        response['cancer_subtype'] = result['disease']
+    
+    return response
+
+def iter_uploaded_images():
+    """Yield ``(name, bytes)`` for every image uploaded as ``images`` files or inside an ``archive``"""
+    for file in request.files.getlist('images'):
+        if allowed_file(file.filename):
+            yield file.filename, file.read()
+    
+    archive = request.files.get('archive')
+    if archive is None:
+        return
+    stream = archive.stream
+    if zipfile.is_zipfile(stream):
+        stream.seek(0)
+        with zipfile.ZipFile(stream) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and allowed_file(info.filename):
+                    yield info.filename, zf.read(info)
+    else:
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode='r:*') as tf_archive:
+            for member in tf_archive:
+                if member.isfile() and allowed_file(member.name):
+                    yield member.name, tf_archive.extractfile(member).read()
+
+def admit_request():
+    """Admit the request under the load limits; returns ``(ticket, None)`` or ``(None, error_response)``"""
+    client = request.remote_addr
+    if config.ADMISSION_CLIENT_HEADER:
+        client = request.headers.get(config.ADMISSION_CLIENT_HEADER, client)
     try:
-        heatmap_path = os.path.join(STATIC_DIR, 'heatmaps', filename)
-        logger.info(f"Looking for heatmap at: {heatmap_path}")
-        logger.info(f"File exists: {os.path.exists(heatmap_path)}")
-        return send_from_directory(os.path.join(STATIC_DIR, 'heatmaps'), filename)
-    except Exception as e:
-        logger.error(f"Error serving heatmap {filename}: {str(e)}")
-        return "File not found", 404
+        return admission.admit(client), None
+    except Overloaded as e:
+        response = jsonify({'status': 'error', 'error': str(e), 'reason': e.reason})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return None, (response, 429)
 
-@app.route('/predict', methods=['POST'])
-def predict():
+def mark_heatmap_skipped(result, ticket):
+    """Record in ``degraded`` that the load level left ``result`` without a heatmap"""
+    if ticket.skip_heatmap and result.get('visualization') is None and result.get('model_used') != 'error':
+        return dict(result, degraded=result.get('degraded', []) + ['heatmap'])
+    return result
+
+def read_upload():
+    """Decode the ``image`` upload; returns ``(scan_image, None)`` or ``(None, error_response)``"""
+    if request.content_length is not None and request.content_length > MAX_IMAGE_SIZE:
+        return None, (jsonify({'status': 'error', 'error': 'File too large'}), 413)
+    
     if 'image' not in request.files:
-        return jsonify({'status': 'error', 'error': 'No file part'}), 400
+        return None, (jsonify({'status': 'error', 'error': 'No file part'}), 400)
     
     file = request.files['image']
     if file.filename == '':
-        return jsonify({'status': 'error', 'error': 'No selected file'}), 400
+        return None, (jsonify({'status': 'error', 'error': 'No selected file'}), 400)
     
     if not allowed_file(file.filename):
-        return jsonify({'status': 'error', 'error': 'File type not allowed'}), 400
+        return None, (jsonify({'status': 'error', 'error': 'File type not allowed'}), 400)
+    
+    try:
+        # Decode the upload straight from memory, once for the whole pipeline
+        with METRICS.time('lung_stage_seconds', stage='decode'):
+            return decode_image(file.read()), None
+    except ValueError as e:
+        return None, (jsonify({'status': 'error', 'error': str(e)}), 400)
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    ticket, error = admit_request()
+    if error is not None:
+        return error
+    with ticket:
+        return classify_upload(ticket)
+
+def classify_upload(ticket):
+    """Body of ``/predict`` for an admitted request"""
+    scan_image, error = read_upload()
+    if error is not None:
+        return error
     
     # Get scan mode and model type from request
     scan_mode = request.form.get('scan_mode', 'auto')
     model_type = request.form.get('model_type', 'default')
     
     try:
-        # Save the uploaded file
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        logger.info(f"File saved: {filepath}")
-        
-        # Process the image
-        result = processor.process_image(filepath, model_type)
-        logger.info(f"Image processed successfully: {result}")
-        
-        # Clean up the uploaded file
-        os.remove(filepath)
-        logger.info(f"Temporary file removed: {filepath}")
-        
-        # Format response to match frontend expectations
-        response = {
-            'status': 'success',
-            'image_type': result['scan_type'],
-            'disease_type': result['disease'],
-            'disease_probability': result['confidence'],
-            'model_used': result['model_used'],
-            'visualization': result['visualization'],  # This will now be a URL to the heatmap image
-            'all_predictions': result['all_predictions']
-        }
+        # Process the image; under load the ensemble and then Grad-CAM are shed
+        result = processor.process_image(
+            scan_image, model_type, with_heatmap=not ticket.skip_heatmap, single_model=ticket.skip_ensemble
+        )
+        result = mark_heatmap_skipped(result, ticket)
+        logger.debug("Image processed successfully: %s", result)
         
-        # Add additional fields based on disease type
-        if result['disease'] == 'pneumonia':
-            response['pneumonia_severity'] = 'moderate'  # Placeholder severity
-        elif result['disease'] in ['Adenocarcinoma', 'Large Cell Carcinoma', 'Squamous Cell Carcinoma']:
-            response['cancer_subtype'] = result['disease']
-        
-        return jsonify(response)
+        return jsonify(format_result(result))
         
     except Exception as e:
-        logger.error(f"Error processing image: {str(e)}")
+        logger.error("Error processing image: %s", e)
         return jsonify({
             'status': 'error',
             'error': str(e),
@@ -179,10 +291,193 @@ def predict():
             'all_predictions': {}
         }), 500
 
+def format_job(job):
+    """A job snapshot in the ``/predict`` response format plus its heatmap state"""
+    response = format_result(job['result'])
+    response.update({
+        'job_id': job['job_id'],
+        'heatmap_status': job['heatmap_status'],
+        'heatmap_error': job['heatmap_error'],
+        'status_url': f"/jobs/{job['job_id']}",
+        'events_url': f"/jobs/{job['job_id']}/events",
+    })
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Classify an image and return at once; the heatmap is rendered in the background"""
+    ticket, error = admit_request()
+    if error is not None:
+        return error
+    with ticket:
+        scan_image, error = read_upload()
+        if error is not None:
+            return error
+        
+        model_type = request.form.get('model_type', 'default')
+        result = processor.process_image(scan_image, model_type, with_heatmap=False, single_model=ticket.skip_ensemble)
+    
+    render = None
+    if ticket.skip_heatmap:
+        result = mark_heatmap_skipped(result, ticket)
+    elif result['visualization'] is None and result['model_used'] != 'error':
+        render = lambda: processor.render_heatmap(scan_image, result, model_type)
+    try:
+        job = jobs.submit(result, render)
+    except JobsFull as e:
+        response = jsonify({'status': 'error', 'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return jsonify(format_job(job)), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Poll a job: its diagnosis and, once rendered, its heatmap"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'error': 'Unknown or expired job'}), 404
+    return jsonify(format_job(job))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-sent events: ``classification`` at once, then ``heatmap`` when it is rendered"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'error': 'Unknown or expired job'}), 404
+    
+    def generate():
+        yield f"event: classification\ndata: {json.dumps(format_job(job))}\n\n"
+        while True:
+            current = jobs.wait(job_id, timeout=15)
+            if current is None:
+                yield "event: error\ndata: {\"error\": \"Unknown or expired job\"}\n\n"
+                return
+            if current['heatmap_status'] == 'pending':
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: heatmap\ndata: {json.dumps(format_job(current))}\n\n"
+            return
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """Classify many images (``images`` files or a zip/tar ``archive``), streaming NDJSON results"""
+    if not request.files.getlist('images') and 'archive' not in request.files:
+        return jsonify({'status': 'error', 'error': 'No images or archive uploaded'}), 400
+    
+    ticket, error = admit_request()
+    if error is not None:
+        return error
+    
+    model_type = request.form.get('model_type', 'default')
+    with_heatmaps = request.form.get('heatmaps', 'true').lower() not in ('false', '0', 'no')
+    
+    def generate():
+        try:
+            results = processor.process_batch(
+                iter_uploaded_images(), model_type, with_heatmaps=with_heatmaps and not ticket.skip_heatmap,
+                chunk_size=config.BATCH_CHUNK_SIZE, single_model=ticket.skip_ensemble
+            )
+            for name, result in results:
+                if 'error' in result:
+                    line = {'status': 'error', 'error': result['error']}
+                else:
+                    line = format_result(mark_heatmap_skipped(result, ticket) if with_heatmaps else result)
+                line['filename'] = name
+                yield json.dumps(line) + '\n'
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            yield json.dumps({'status': 'error', 'error': f'Could not read archive: {str(e)}'}) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # The slot is held until the whole stream has been sent (or abandoned)
+    response.call_on_close(ticket.release)
+    return response
+
+@app.route('/predict_study', methods=['POST'])
+def predict_study():
+    """Classify a DICOM study (a multi-frame file or a zip of slices) and report its top slices"""
+    file = request.files.get('study')
+    if file is None or file.filename == '':
+        return jsonify({'status': 'error', 'error': 'No study uploaded'}), 400
+    if '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in STUDY_EXTENSIONS:
+        return jsonify({'status': 'error', 'error': 'File type not allowed'}), 400
+    
+    model_type = request.form.get('model_type', 'default')
+    with_heatmaps = request.form.get('heatmaps', 'true').lower() not in ('false', '0', 'no')
+    try:
+        top_k = max(0, int(request.form.get('top_k', config.STUDY_TOP_K)))
+    except ValueError:
+        return jsonify({'status': 'error', 'error': 'top_k must be an integer'}), 400
+    
+    ticket, error = admit_request()
+    if error is not None:
+        return error
+    with ticket:
+        try:
+            series = open_series(file.read())
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        try:
+            result = processor.process_study(
+                series, model_type, top_k=top_k, batch_size=config.STUDY_BATCH_SIZE,
+                with_heatmaps=with_heatmaps and not ticket.skip_heatmap, single_model=ticket.skip_ensemble
+            )
+        except ValueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        except Exception as e:
+            logger.exception("Error processing study: %s", e)
+            return jsonify({'status': 'error', 'error': str(e)}), 500
+        finally:
+            series.close()
+    if with_heatmaps and ticket.skip_heatmap:
+        result['degraded'] = result['degraded'] + ['heatmap']
+    return jsonify(dict(result, status='success'))
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    return jsonify({'status': 'healthy'})
+    """Health check endpoint; ``ready`` stays false until the warm-up is done (see /ready)"""
+    return jsonify({'status': 'healthy', 'ready': processor.registry.is_ready()})
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: reports which models are loaded and holds until warm-up is done"""
+    status = processor.registry.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and size of the result cache"""
+    return jsonify(processor.cache.stats())
+
+@app.route('/stats/heatmaps', methods=['GET'])
+def heatmap_stats():
+    """Size and eviction counters of the heatmap store"""
+    return jsonify(processor.heatmap_generator.store.stats())
+
+@app.route('/stats/jobs', methods=['GET'])
+def job_stats():
+    """Number of kept and pending jobs of the asynchronous job API"""
+    return jsonify(jobs.stats())
+
+@app.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    """Requests in flight and how often each load level was reached"""
+    return jsonify(admission.stats())
+
+@app.route('/stats/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Queue depth and realised batch sizes of the micro-batching scheduler"""
+    return jsonify(processor.scheduler.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Per-stage and per-model latency histograms, counters and gauges in Prometheus text format"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000) 
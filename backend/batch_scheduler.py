@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class _PendingRequest:
+    def __init__(self, img_array):
+        self.img_array = img_array
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class _ModelQueue:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.batches = 0
+        self.images = 0
+        self.batch_sizes = {}
+        self.worker = None
+
+
+class MicroBatchScheduler:
+    """Groups concurrent predictions for the same model into one forward pass.
+
+    Every model gets its own queue and worker thread. A worker flushes its
+    queue as soon as ``max_batch_size`` images are waiting or the oldest
+    request has waited ``max_wait_ms``, runs ``predict_fn(model_name, batch)``
+    once and hands each caller back its own rows of the output. Requests are
+    only batched with requests of the same image size.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._running = True
+
+    def _get_queue(self, model_name):
+        with self._lock:
+            queue = self._queues.get(model_name)
+            if queue is None:
+                queue = _ModelQueue(model_name)
+                queue.worker = threading.Thread(
+                    target=self._worker_loop,
+                    args=(queue,),
+                    name=f"batch-{model_name}",
+                    daemon=True,
+                )
+                self._queues[model_name] = queue
+                queue.worker.start()
+            return queue
+
+    def submit(self, model_name, img_array):
+        """Queue ``img_array`` (shape ``(n, ...)``) and return a Future of its predictions."""
+        if not self._running:
+            raise RuntimeError("Scheduler has been shut down")
+        request = _PendingRequest(img_array)
+        queue = self._get_queue(model_name)
+        with queue.condition:
+            queue.pending.append(request)
+            queue.condition.notify()
+        return request.future
+
+    def predict(self, model_name, img_array, timeout=None):
+        """Blocking counterpart of :meth:`submit`."""
+        return self.submit(model_name, img_array).result(timeout=timeout)
+
+    def _take_batch(self, queue):
+        with queue.condition:
+            while self._running and not queue.pending:
+                queue.condition.wait()
+            if not queue.pending:
+                return None
+
+            # Hold the batch open until it is full or the oldest request is due
+            deadline = queue.pending[0].enqueued_at + self.max_wait
+            while self._running and self._queued_images(queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                queue.condition.wait(remaining)
+
+            # Only images of the oldest request's size can share its forward
+            # pass; the others keep their place for the next batch
+            batch = []
+            skipped = []
+            size = 0
+            shape = queue.pending[0].img_array.shape[1:]
+            while queue.pending:
+                if queue.pending[0].img_array.shape[1:] != shape:
+                    skipped.append(queue.pending.popleft())
+                    continue
+                rows = len(queue.pending[0].img_array)
+                if batch and size + rows > self.max_batch_size:
+                    break
+                batch.append(queue.pending.popleft())
+                size += rows
+            queue.pending.extendleft(reversed(skipped))
+            return batch
+
+    @staticmethod
+    def _queued_images(queue):
+        return sum(len(request.img_array) for request in queue.pending)
+
+    def _worker_loop(self, queue):
+        while True:
+            batch = self._take_batch(queue)
+            if batch is None:
+                return
+            self._run_batch(queue, batch)
+
+    def _run_batch(self, queue, batch):
+        try:
+            if len(batch) == 1:
+                inputs = batch[0].img_array
+            else:
+                inputs = np.concatenate([request.img_array for request in batch], axis=0)
+            outputs = self.predict_fn(queue.model_name, inputs)
+            # predict_fn may return several per-row outputs, e.g. scores and heatmaps
+            multiple = isinstance(outputs, (tuple, list))
+            outputs = tuple(np.asarray(output) for output in outputs) if multiple else np.asarray(outputs)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        offset = 0
+        for request in batch:
+            rows = len(request.img_array)
+            if multiple:
+                request.future.set_result(tuple(output[offset:offset + rows] for output in outputs))
+            else:
+                request.future.set_result(outputs[offset:offset + rows])
+            offset += rows
+
+        with queue.condition:
+            queue.batches += 1
+            queue.images += len(inputs)
+            queue.batch_sizes[len(inputs)] = queue.batch_sizes.get(len(inputs), 0) + 1
+
+    def stats(self):
+        """Queue depth and realised batch sizes per model."""
+        with self._lock:
+            queues = list(self._queues.values())
+        stats = {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'models': {},
+        }
+        for queue in queues:
+            with queue.condition:
+                stats['models'][queue.model_name] = {
+                    'queue_depth': self._queued_images(queue),
+                    'batches': queue.batches,
+                    'images': queue.images,
+                    'mean_batch_size': queue.images / queue.batches if queue.batches else 0.0,
+                    'batch_sizes': dict(sorted(queue.batch_sizes.items())),
+                }
+        return stats
+
+    def shutdown(self):
+        self._running = False
+        with self._lock:
+            queues = list(self._queues.values())
+        for queue in queues:
+            with queue.condition:
+                queue.condition.notify_all()
+        for queue in queues:
+            queue.worker.join(timeout=5)
@@ -0,0 +1,12 @@
+"""Offline benchmarks for the backend.
+
+Run from the ``backend`` directory:
+
+    python -m benchmarks.micro --output results/micro.json
+    python -m benchmarks.server --port 5001 &
+    python -m benchmarks.load --url http://localhost:5001 --server-pid <pid> --output results/load.json
+    python -m benchmarks.compare results/before.json results/after.json
+
+Everything runs on synthetic images and randomly initialised models with the
+production architectures, so no weights, network or GPU are needed.
+"""
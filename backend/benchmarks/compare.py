@@ -0,0 +1,41 @@
+import argparse
+import json
+
+
+def flatten(value, prefix=''):
+    """Flatten nested result dicts/lists into ``{'a.b.c': number}``."""
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(flatten(item, f'{prefix}{key}.'))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            flat.update(flatten(item, f'{prefix}{i}.'))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        flat[prefix[:-1]] = value
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--metrics', nargs='+', default=['p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'throughput_rps',
+                                                          'peak_rss_mb', 'server_peak_rss_mb'])
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = flatten(json.load(f)['results'])
+    with open(args.candidate) as f:
+        candidate = flatten(json.load(f)['results'])
+
+    for key in sorted(set(baseline) & set(candidate)):
+        if key.rsplit('.', 1)[-1] not in args.metrics:
+            continue
+        before, after = baseline[key], candidate[key]
+        change = (after - before) / before * 100.0 if before else float('nan')
+        print(f"{key:70s} {before:12.2f} -> {after:12.2f} ({change:+6.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.synthetic import child_pids, environment, peak_rss_mb, pss_mb, summarize, synthetic_uploads
+
+
+def run(url, uploads, concurrency, total_requests, model_type, server_pid):
+    latencies = []
+    status_counts = {}
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+    rss_samples = []
+    worker_rss = {}
+    pss_samples = []
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.is_set():
+            rss = peak_rss_mb(server_pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            # Worker processes of serve.py (gunicorn), if the server has any
+            workers = child_pids(server_pid)
+            for pid in workers:
+                rss = peak_rss_mb(pid)
+                if rss is not None:
+                    worker_rss[pid] = max(rss, worker_rss.get(pid, 0.0))
+            pss = [pss_mb(pid) for pid in [server_pid] + workers]
+            if all(value is not None for value in pss):
+                pss_samples.append(sum(pss))
+            done.wait(0.5)
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            name, data = uploads[i % len(uploads)]
+            start = time.perf_counter()
+            try:
+                response = session.post(
+                    f'{url}/predict',
+                    files={'image': (name, data)},
+                    data={'model_type': model_type},
+                    timeout=300,
+                )
+                status = str(response.status_code)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = (time.perf_counter() - start) * 1000.0
+            with lock:
+                status_counts[status] = status_counts.get(status, 0) + 1
+                if status == '200':
+                    latencies.append(elapsed)
+
+    sampler = None
+    if server_pid:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - start
+    done.set()
+    if sampler is not None:
+        sampler.join()
+
+    results = {
+        'requests': total_requests,
+        'concurrency': concurrency,
+        'wall_time_s': wall,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'status_counts': status_counts,
+        'latency': summarize(latencies) if latencies else None,
+        'server_peak_rss_mb': max(rss_samples) if rss_samples else None,
+        'worker_peak_rss_mb': [round(worker_rss[pid], 1) for pid in sorted(worker_rss)],
+        'server_peak_pss_mb': max(pss_samples) if pss_samples else None,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive /predict with synthetic uploads and report throughput and latency.")
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help="One run per concurrency level")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per run")
+    parser.add_argument('--images', type=int, default=16, help="Distinct synthetic images to cycle through")
+    parser.add_argument('--model-type', default='default')
+    parser.add_argument('--server-pid', type=int,
+                        help="Server process (serve.py: its master) to sample peak RSS and PSS from (Linux)")
+    parser.add_argument('--output', default='benchmark_load.json')
+    args = parser.parse_args()
+
+    uploads = synthetic_uploads(args.images)
+    runs = []
+    for concurrency in args.concurrency:
+        result = run(args.url, uploads, concurrency, args.requests, args.model_type, args.server_pid)
+        runs.append(result)
+        latency = result['latency'] or {}
+        print(f"concurrency {concurrency:3d}: {result['throughput_rps']:.1f} req/s, "
+              f"p50 {latency.get('p50_ms', 0):.0f} ms, p95 {latency.get('p95_ms', 0):.0f} ms, "
+              f"p99 {latency.get('p99_ms', 0):.0f} ms, statuses {result['status_counts']}")
+        if result['worker_peak_rss_mb']:
+            print(f"  worker peak RSS {result['worker_peak_rss_mb']} MB, "
+                  f"server total PSS {result['server_peak_pss_mb']:.0f} MB")
+
+    results = {
+        'benchmark': 'load',
+        'environment': environment(),
+        'parameters': vars(args),
+        'results': runs,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import encode, environment, peak_rss_mb, summarize, synthetic_ct, synthetic_xray, use_random_models
+from heatmap_store import HeatmapStore
+from image_processor import SCAN_MODELS, ImageProcessor
+from overlay_renderer import fit_size
+from scan_image import ScanImage
+
+
+def time_stage(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return summarize(samples)
+
+
+def run(iterations, warmup, xray_size, ct_size):
+    use_random_models()
+    processor = ImageProcessor()
+    generator = processor.heatmap_generator
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = HeatmapStore(tmp, mode='disk', max_files=100)
+        for scan_type, gray in (('xray', synthetic_xray(xray_size)), ('ct', synthetic_ct(ct_size))):
+            data = encode(gray)
+            path = os.path.join(tmp, f'{scan_type}.png')
+            with open(path, 'wb') as f:
+                f.write(data)
+            scan_image = ScanImage.from_bytes(data)
+            pixels = scan_image.pixels
+
+            stages = {
+                'decode': lambda: ScanImage.from_bytes(data),
+                'preprocess_image': lambda: processor.preprocess_image(path),
+                'detect_scan_type': lambda: processor.detect_scan_type(pixels),
+            }
+            cam = None
+            for model_name in SCAN_MODELS[scan_type]:
+                model = processor.keras_model(model_name)
+                layer = generator.model_layers[model_name]
+                # model alone, without the scheduler's batching window
+                stages[f'model:{model_name}'] = lambda model=model: model.predict_on_batch(pixels)
+                stages[f'get_heatmap:{model_name}'] = (
+                    lambda model=model, layer=layer: generator.get_heatmap(model, pixels, layer)
+                )
+                stages[f'fused_gradcam:{model_name}'] = (
+                    lambda model=model, model_name=model_name: generator.predict_with_heatmap(model_name, pixels, model)
+                )
+                if cam is None:
+                    cam = generator.predict_with_heatmap(model_name, pixels, model)[1][0]
+            # Both models as served: one after the other, and as one ensemble graph
+            members = [processor.registry.get(model_name) for model_name in SCAN_MODELS[scan_type]]
+            ensemble = processor.registry.get(f'ensemble_{scan_type}')
+            stages['ensemble_sequential'] = lambda members=members: [m.predict_on_batch(pixels) for m in members]
+            stages['ensemble_graph'] = lambda ensemble=ensemble: ensemble.predict_on_batch(pixels)
+
+            renderer = generator.renderer
+            height, width = scan_image.height, scan_image.width
+            full = fit_size(height, width, generator.sizes['full'])
+            overlay = renderer.blend(scan_image.original, cam, *full)[0].copy()
+            encoded = renderer.encode(overlay)
+            stages['blend_original_size'] = lambda: renderer.blend(scan_image.original, cam, height, width)
+            stages['blend_full_variant'] = lambda: renderer.blend(scan_image.original, cam, *full)
+            stages['encode'] = lambda: renderer.encode(overlay)
+            stages['store_write'] = lambda: store.save(encoded, renderer.extension)
+            stages['render_all_variants'] = lambda: renderer.render(scan_image.original, cam, generator.sizes)
+
+            results[scan_type] = {
+                'image_size': list(scan_image.original.shape),
+                'stages': {},
+            }
+            for name, fn in stages.items():
+                results[scan_type]['stages'][name] = time_stage(fn, iterations, warmup)
+                print(f"{scan_type:5s} {name:40s} p50 {results[scan_type]['stages'][name]['p50_ms']:9.2f} ms")
+
+    processor.scheduler.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic images and random models.")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--xray-size', type=int, default=1024)
+    parser.add_argument('--ct-size', type=int, default=512)
+    parser.add_argument('--output', default='benchmark_micro.json')
+    args = parser.parse_args()
+
+    results = {
+        'benchmark': 'micro',
+        'environment': environment(),
+        'parameters': vars(args),
+        'results': run(args.iterations, args.warmup, args.xray_size, args.ct_size),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
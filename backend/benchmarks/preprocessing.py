@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from benchmarks.synthetic import encode, environment, summarize, synthetic_ct, synthetic_xray
+from model_builders import INPUT_SHAPE, MODEL_SPECS, fit_input_size
+from scan_image import ScanImage
+
+
+def host_preprocess(scan_image):
+    """The preprocessing every request used to do in Python before each model call."""
+    resized = Image.fromarray(scan_image.original).resize(INPUT_SHAPE[:2], Image.NEAREST)
+    tensor = np.asarray(resized, dtype=np.float32) / 255.0
+    return np.expand_dims(tensor, axis=0)
+
+
+def time_requests(stages, iterations, warmup):
+    """Per-call wall and CPU time (all threads of this process, TensorFlow's included) in ms.
+
+    The stages are timed in turn within every iteration so that drift in
+    machine load affects them alike.
+    """
+    for _ in range(warmup):
+        for fn in stages.values():
+            fn()
+    wall = {name: [] for name in stages}
+    cpu = {name: [] for name in stages}
+    for _ in range(iterations):
+        for name, fn in stages.items():
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            fn()
+            cpu[name].append((time.process_time() - cpu_start) * 1000.0)
+            wall[name].append((time.perf_counter() - wall_start) * 1000.0)
+    return {name: {'wall': summarize(wall[name]), 'cpu': summarize(cpu[name])} for name in stages}
+
+
+def run(model_names, iterations, warmup, xray_size, ct_size):
+    results = {}
+    for model_name in model_names:
+        builder, _ = MODEL_SPECS[model_name]
+        model = builder()
+        # The same network without its preprocessing layers: float32 224x224 input
+        host_model = tf.keras.Model(model.get_layer('rescale').output, model.output)
+        results[model_name] = {}
+        for scan_type, gray in (('xray', synthetic_xray(xray_size)), ('ct', synthetic_ct(ct_size))):
+            scan_image = ScanImage.from_bytes(encode(gray))
+            stages = {
+                'host_preprocess': lambda: host_preprocess(scan_image),
+                'host_request': lambda: host_model.predict_on_batch(host_preprocess(scan_image)),
+                # What the server does: uint8 nearest resize on the host (ScanImage.pixels),
+                # rescale in the graph, whose resize layer is then a no-op
+                'host_resize_request': lambda: model.predict_on_batch(fit_input_size(scan_image.original[np.newaxis])),
+                # The full-size upload resized by the graph, as for callers of exported models
+                'in_graph_resize_request': lambda: model.predict_on_batch(scan_image.original[np.newaxis]),
+            }
+            timings = time_requests(stages, iterations, warmup)
+            host_cpu = timings['host_request']['cpu']['mean_ms']
+            served_cpu = timings['host_resize_request']['cpu']['mean_ms']
+            graph_cpu = timings['in_graph_resize_request']['cpu']['mean_ms']
+            results[model_name][scan_type] = {
+                'image_size': list(scan_image.original.shape),
+                'input_bytes': {
+                    'host_float32': int(host_preprocess(scan_image).nbytes),
+                    'host_resize_uint8': int(scan_image.pixels.nbytes),
+                    'in_graph_resize_uint8': int(scan_image.original.nbytes),
+                },
+                'stages': timings,
+                'cpu_ms_saved_per_request': round(host_cpu - served_cpu, 3),
+            }
+            print(f"{model_name:20s} {scan_type:5s} cpu/request float32 host {host_cpu:8.2f} ms  "
+                  f"uint8 host resize {served_cpu:8.2f} ms  in-graph resize {graph_cpu:8.2f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-request CPU time of the old float32 host preprocessing with the "
+                    "served uint8 host resize + in-graph rescale, and with resizing in the graph, "
+                    "on synthetic images and random models."
+    )
+    parser.add_argument('--models', nargs='+', default=['scan_classifier', 'xray_mobilenetv2'],
+                        choices=list(MODEL_SPECS))
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--xray-size', type=int, default=1024)
+    parser.add_argument('--ct-size', type=int, default=512)
+    parser.add_argument('--output', default='benchmark_preprocessing.json')
+    args = parser.parse_args()
+
+    results = {
+        'benchmark': 'preprocessing',
+        'environment': environment(),
+        'parameters': vars(args),
+        'results': run(args.models, args.iterations, args.warmup, args.xray_size, args.ct_size),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import argparse
+
+from benchmarks.synthetic import use_random_models
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the backend with randomly initialised models for load tests.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="run serve.py with this many worker processes instead of one Flask process")
+    parser.add_argument('--backend', default='keras', help="serve.py --backend, with --workers")
+    args = parser.parse_args()
+
+    if args.workers:
+        import serve
+
+        class RandomModelServer(serve.ServerApplication):
+            def load(self):
+                # In each worker, after the fork
+                use_random_models()
+                return super().load()
+
+        serve.ServerApplication = RandomModelServer
+        serve.main(['--workers', str(args.workers), '--bind', f'{args.host}:{args.port}', '--backend', args.backend])
+        return
+
+    # Must happen before app is imported: importing it builds the ImageProcessor
+    use_random_models()
+    from app import app
+    app.run(host=args.host, port=args.port, threaded=True, debug=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import io
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from model_builders import MODEL_SPECS
+
+
+def synthetic_xray(size=1024, seed=0):
+    """A chest X-ray lookalike: bright body with two darker lung fields."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    img = 0.75 - 0.25 * np.abs(x - 0.5)
+    for cx in (0.33, 0.67):
+        lung = ((x - cx) / 0.14) ** 2 + ((y - 0.5) / 0.3) ** 2 < 1
+        img[lung] -= 0.45
+    img += rng.normal(0, 0.04, img.shape)
+    return (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+
+def synthetic_ct(size=512, seed=0):
+    """An axial chest CT lookalike: round body on black with two dark lungs and nodules."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    img = np.zeros((size, size))
+    body = ((x - 0.5) / 0.45) ** 2 + ((y - 0.5) / 0.35) ** 2 < 1
+    img[body] = 0.6
+    for cx in (0.32, 0.68):
+        lung = ((x - cx) / 0.15) ** 2 + ((y - 0.5) / 0.24) ** 2 < 1
+        img[lung] = 0.1
+    for _ in range(3):
+        nx, ny = rng.uniform(0.25, 0.75), rng.uniform(0.35, 0.65)
+        img[((x - nx) ** 2 + (y - ny) ** 2) < 0.0004] = 0.7
+    img += rng.normal(0, 0.03, img.shape)
+    return (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+
+def encode(gray, fmt='PNG'):
+    buffer = io.BytesIO()
+    Image.fromarray(gray).convert('RGB').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def synthetic_uploads(count, xray_size=1024, ct_size=512, fmt='PNG'):
+    """``count`` encoded uploads alternating between X-ray and CT, as ``(name, bytes)``."""
+    uploads = []
+    for i in range(count):
+        if i % 2 == 0:
+            uploads.append((f'xray_{i}.{fmt.lower()}', encode(synthetic_xray(xray_size, seed=i), fmt)))
+        else:
+            uploads.append((f'ct_{i}.{fmt.lower()}', encode(synthetic_ct(ct_size, seed=i), fmt)))
+    return uploads
+
+
+def random_model(model_name):
+    """``model_name``'s architecture with random weights instead of the fine-tuned files."""
+    builder, _ = MODEL_SPECS[model_name]
+    return builder()
+
+
+def use_random_models():
+    """Make ImageProcessor build randomly initialised models instead of reading models/."""
+    import image_processor
+    image_processor.load_model = random_model
+
+
+def summarize(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {
+        'count': int(len(samples)),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'min_ms': float(samples.min()),
+        'max_ms': float(samples.max()),
+    }
+
+
+def environment():
+    """Metadata recorded with every result file so runs can be compared."""
+    info = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        import tensorflow as tf
+        info['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+    try:
+        info['git_commit'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        pass
+    return info
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident set size of ``pid`` (default: this process) in MB, or None if unavailable."""
+    if pid is not None:
+        # VmHWM is the process's RSS high-water mark (Linux only)
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024.0
+        except OSError:
+            return None
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def child_pids(pid):
+    """Direct children of ``pid``, e.g. the workers of a gunicorn master (Linux only)."""
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+    return sorted(set(children))
+
+
+def pss_mb(pid):
+    """Proportional set size of ``pid`` in MB, or None if unavailable (Linux only).
+
+    Pages shared with other processes count as a share of their size, so the
+    sum over the workers counts weights they share once.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
@@ -0,0 +1,127 @@
+import argparse
+import json
+
+import numpy as np
+
+from convert_tflite import MODEL_CLASSES, find_images, load_tensors, predicted_classes, time_per_image
+from image_processor import CASCADES
+from model_builders import MODELS_DIR, load_model
+
+
+def confidences(outputs):
+    """Confidence of the predicted class, as reported in ``all_predictions``."""
+    if outputs.shape[-1] == 1:
+        return np.maximum(outputs[:, 0], 1 - outputs[:, 0])
+    return np.max(outputs, axis=-1)
+
+
+def run_model(model, tensors, batch_size=32):
+    return np.concatenate([
+        np.asarray(model.predict_on_batch(tensors[i:i + batch_size]))
+        for i in range(0, len(tensors), batch_size)
+    ])
+
+
+def sweep(first, second, labels, classes, thresholds):
+    """Trade-off of each threshold against running both models (``ensemble``) and the first alone.
+
+    ``first`` and ``second`` are ``(outputs, ms_per_image)`` of the two
+    cascade models on the same images.
+    """
+    (first_outputs, first_ms), (second_outputs, second_ms) = first, second
+    first_classes, second_classes = predicted_classes(first_outputs), predicted_classes(second_outputs)
+    first_conf, second_conf = confidences(first_outputs), confidences(second_outputs)
+    # Most confident model wins, as in process_image
+    ensemble = np.where(second_conf > first_conf, second_classes, first_classes)
+
+    labelled = np.array([i for i, label in enumerate(labels) if label in classes], dtype=int)
+    truth = np.array([classes.index(labels[i]) for i in labelled], dtype=int)
+
+    rows = []
+    for threshold in thresholds:
+        escalated = first_conf < threshold
+        cascade = np.where(escalated & (second_conf > first_conf), second_classes, first_classes)
+        cost_ms = first_ms + escalated.mean() * second_ms
+        row = {
+            'threshold': round(float(threshold), 3),
+            'escalation_rate': float(escalated.mean()),
+            'second_model_calls_saved': round(float(1 - escalated.mean()), 4),
+            'ms_per_image': round(float(cost_ms), 2),
+            'compute_saved_vs_ensemble': round(float(1 - cost_ms / (first_ms + second_ms)), 4),
+            'agreement_with_ensemble': float(np.mean(cascade == ensemble)),
+            'agreement_with_first_model': float(np.mean(cascade == first_classes)),
+        }
+        if len(labelled):
+            row['accuracy'] = float(np.mean(cascade[labelled] == truth))
+        rows.append(row)
+
+    summary = {
+        'images': len(first_outputs),
+        'labelled_images': len(labelled),
+        'ms_per_image': {'first': round(first_ms, 2), 'second': round(second_ms, 2)},
+    }
+    if len(labelled):
+        summary['accuracy'] = {
+            'first_model': float(np.mean(first_classes[labelled] == truth)),
+            'second_model': float(np.mean(second_classes[labelled] == truth)),
+            'ensemble': float(np.mean(ensemble[labelled] == truth)),
+        }
+    return summary, rows
+
+
+def recommend(rows, target_agreement):
+    """Lowest threshold (fewest escalations) whose agreement with the ensemble meets the target."""
+    for row in rows:
+        if row['agreement_with_ensemble'] >= target_agreement:
+            return row
+    return rows[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calibrate cascade thresholds on a labelled validation set and report "
+                    "compute saved against agreement with running both models."
+    )
+    parser.add_argument('--ct-dir', help="CT validation images (class subfolders enable accuracy)")
+    parser.add_argument('--xray-dir', help="X-ray validation images (class subfolders enable accuracy)")
+    parser.add_argument('--max-images', type=int, default=2000)
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--timing-images', type=int, default=20, help="Images used to time each model")
+    parser.add_argument('--target-agreement', type=float, default=0.99)
+    parser.add_argument('--report', default='cascade_report.json')
+    args = parser.parse_args()
+
+    thresholds = np.round(np.arange(0.5, 1.0, 0.01), 2)
+    report = {}
+    recommended = {}
+    for scan_type, directory in (('ct', args.ct_dir), ('xray', args.xray_dir)):
+        if not directory:
+            continue
+        images = find_images(directory, args.max_images)
+        tensors = load_tensors(images)
+        labels = [label for _, label in images]
+
+        measured = []
+        for model_name in CASCADES[scan_type]:
+            model = load_model(model_name, args.models_dir)
+            _, ms_per_image = time_per_image(model.predict_on_batch, tensors[:args.timing_images])
+            measured.append((run_model(model, tensors), ms_per_image))
+
+        first_name, second_name = CASCADES[scan_type]
+        summary, rows = sweep(measured[0], measured[1], labels, MODEL_CLASSES[first_name], thresholds)
+        best = recommend(rows, args.target_agreement)
+        recommended[scan_type] = best['threshold']
+        report[scan_type] = dict(summary, models=[first_name, second_name], recommended=best, thresholds=rows)
+        print(f"{scan_type}: threshold {best['threshold']} escalates {best['escalation_rate']:.1%}, "
+              f"saves {best['compute_saved_vs_ensemble']:.1%} compute, "
+              f"{best['agreement_with_ensemble']:.2%} agreement with running both models")
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+    if recommended:
+        print("LUNG_CASCADE_THRESHOLDS=" + ','.join(f'{k}={v}' for k, v in recommended.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from model_builders import INPUT_SHAPE
+
+logger = logging.getLogger(__name__)
+
+# Any batch of uint8 RGB images, whatever their size
+IMAGE_SIGNATURE = tf.TensorSpec([None, None, None, 3], tf.uint8)
+
+
+def _to_numpy(outputs):
+    if isinstance(outputs, (list, tuple)):
+        return tuple(output.numpy() for output in outputs)
+    return outputs.numpy()
+
+
+class CompiledModel:
+    """A Keras model served through traced functions with fixed input signatures.
+
+    ``model.predict_on_batch`` retraces its graph for each new input shape it
+    meets, and uploads come in many sizes. Here the whole model is traced once
+    for uint8 images of any size. With ``jit_compile`` the network after the
+    resize layer is compiled by XLA instead; XLA specializes on exact shapes,
+    so batches are zero-padded up to the nearest of ``batch_sizes`` (and split
+    beyond the largest) to keep the set of compiled programs fixed.
+    Exposes ``predict_on_batch`` like a Keras model (a tuple of arrays for
+    a model with several outputs), and the model itself as ``keras_model``
+    for Grad-CAM. ``size_bytes`` is what the registry accounts for it, by
+    default its float32 weights.
+    """
+
+    def __init__(self, model, jit_compile=False, batch_sizes=(1,), size_bytes=None):
+        self.keras_model = model
+        self.jit_compile = jit_compile
+        self.batch_sizes = sorted(set(batch_sizes)) or [1]
+        self.size_bytes = model.count_params() * 4 if size_bytes is None else size_bytes
+        if jit_compile:
+            resize = model.get_layer('resize')
+            network = tf.keras.Model(resize.output, model.output)
+            self._resize = tf.function(resize, input_signature=[IMAGE_SIGNATURE])
+            self._network = tf.function(
+                lambda images: network(images, training=False),
+                input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE, tf.uint8)],
+                jit_compile=True,
+            )
+        else:
+            self._serve = tf.function(lambda images: model(images, training=False),
+                                      input_signature=[IMAGE_SIGNATURE])
+
+    def _padded_size(self, rows):
+        return next((size for size in self.batch_sizes if size >= rows), self.batch_sizes[-1])
+
+    def predict_on_batch(self, batch):
+        batch = tf.convert_to_tensor(batch, tf.uint8)
+        if not self.jit_compile:
+            return _to_numpy(self._serve(batch))
+        resized = self._resize(batch)
+        outputs = []
+        for start in range(0, len(batch), self.batch_sizes[-1]):
+            chunk = resized[start:start + self.batch_sizes[-1]]
+            rows = int(chunk.shape[0])
+            padding = self._padded_size(rows) - rows
+            if padding:
+                chunk = tf.pad(chunk, [[0, padding], [0, 0], [0, 0], [0, 0]])
+            outputs.append(tf.nest.map_structure(lambda output: output[:rows], _to_numpy(self._network(chunk))))
+        return tf.nest.map_structure(lambda *parts: np.concatenate(parts), *outputs)
+
+    def warm_up(self):
+        """Trace (and compile) every batch size by running blank images through it; returns seconds taken."""
+        start = time.perf_counter()
+        for size in self.batch_sizes:
+            self.predict_on_batch(np.zeros((size,) + INPUT_SHAPE, np.uint8))
+        return time.perf_counter() - start
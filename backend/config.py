@@ -0,0 +1,176 @@
+import os
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def _env_list(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _env_mapping(name, default):
+    """Parse ``"key=value,key=value"`` into a dict."""
+    value = os.environ.get(name)
+    if not value:
+        return dict(default)
+    mapping = dict(default)
+    for item in value.split(','):
+        if '=' in item:
+            key, item_value = item.split('=', 1)
+            mapping[key.strip()] = item_value.strip()
+    return mapping
+
+
+# Log level of the backend; DEBUG adds per-request tracing of the pipeline
+LOG_LEVEL = os.environ.get('LUNG_LOG_LEVEL', 'INFO').upper()
+
+# TensorFlow thread pools of this process (0 lets TensorFlow use every core).
+# serve.py sets them per worker so that workers do not oversubscribe cores.
+TF_INTRA_OP_THREADS = _env_int('LUNG_TF_INTRA_OP_THREADS', 0)
+TF_INTER_OP_THREADS = _env_int('LUNG_TF_INTER_OP_THREADS', 0)
+
+# Micro-batching scheduler: requests for the same model are grouped until
+# either BATCH_MAX_SIZE images are queued or the oldest one has waited
+# BATCH_MAX_WAIT_MS milliseconds, whichever comes first.
+BATCH_MAX_SIZE = _env_int('LUNG_BATCH_MAX_SIZE', 8)
+BATCH_MAX_WAIT_MS = _env_float('LUNG_BATCH_MAX_WAIT_MS', 5.0)
+
+# Cascade mode (model_type "cascade", or every auto request when AUTO_MODE is
+# "cascade"): the first model of the scan type runs alone and the second only
+# when the first one's confidence is below CASCADE_THRESHOLDS[scan_type].
+# Calibrate the thresholds with calibrate_cascade.py.
+AUTO_MODE = os.environ.get('LUNG_AUTO_MODE', 'max-confidence')
+CASCADE_THRESHOLDS = {
+    scan_type: float(threshold)
+    for scan_type, threshold in _env_mapping('LUNG_CASCADE_THRESHOLDS', {'ct': '0.8', 'xray': '0.9'}).items()
+}
+
+# When both models of a scan type run (model_type "ensemble", or auto X-ray
+# requests) and both are served by Keras, they run as one graph over a shared
+# input (ENSEMBLE_GRAPH) instead of two predictions in sequence. The reported
+# diagnosis is the ENSEMBLE_FUSION of their outputs: "max-confidence" (the
+# most confident model), "mean", or "weighted" by ENSEMBLE_WEIGHTS, e.g.
+# LUNG_ENSEMBLE_WEIGHTS="ct_efficientnetv2s=2,ct_resnet50=1" (default 1).
+ENSEMBLE_GRAPH = _env_int('LUNG_ENSEMBLE_GRAPH', 1) == 1
+ENSEMBLE_FUSION = os.environ.get('LUNG_ENSEMBLE_FUSION', 'max-confidence')
+ENSEMBLE_WEIGHTS = {
+    model_name: float(weight)
+    for model_name, weight in _env_mapping('LUNG_ENSEMBLE_WEIGHTS', {}).items()
+}
+
+# Model pool: models load on first use. Once the estimated size of the
+# resident models exceeds MODEL_MEMORY_BUDGET_MB (0 = unlimited) the least
+# recently used ones are unloaded. MODEL_WARMUP lists models to load eagerly
+# at startup ("all" for every model); readiness waits for them.
+MODEL_MEMORY_BUDGET_MB = _env_int('LUNG_MODEL_MEMORY_BUDGET_MB', 0)
+MODEL_WARMUP = _env_list('LUNG_MODEL_WARMUP', ['scan_classifier'])
+
+# Keras models are served through graphs traced once for uint8 images of any
+# size. With WARMUP_INFERENCE the warm-up models also run blank 224x224
+# batches of each WARMUP_BATCH_SIZES size (and a Grad-CAM pass) before
+# readiness, so no request pays for tracing. XLA_COMPILE compiles the networks
+# with XLA (batches are padded to the nearest WARMUP_BATCH_SIZES size);
+# XLA_CACHE_DIR persists the compiled programs across restarts where the
+# runtime supports it (TensorFlow's GPU compiler, not its CPU one).
+WARMUP_INFERENCE = _env_int('LUNG_WARMUP_INFERENCE', 1) == 1
+WARMUP_BATCH_SIZES = [int(size) for size in _env_list('LUNG_WARMUP_BATCH_SIZES', [1, BATCH_MAX_SIZE])]
+XLA_COMPILE = _env_int('LUNG_XLA_COMPILE', 0) == 1
+XLA_CACHE_DIR = os.environ.get('LUNG_XLA_CACHE_DIR', '')
+
+# Inference backend per model: "keras" (the float32 reference), "tflite-float16"
+# or "tflite-int8", e.g. LUNG_INFERENCE_BACKENDS="xray_vgg16=tflite-int8".
+# TFLite files are created with convert_tflite.py. Each TFLite model is served
+# by TFLITE_INTERPRETERS interpreters running TFLITE_THREADS threads each
+# (0 lets TFLite decide).
+INFERENCE_BACKENDS = _env_mapping('LUNG_INFERENCE_BACKENDS', {})
+TFLITE_INTERPRETERS = _env_int('LUNG_TFLITE_INTERPRETERS', 2)
+TFLITE_THREADS = _env_int('LUNG_TFLITE_THREADS', 0)
+
+# Result cache keyed by the hash of the decoded image plus model_type.
+# RESULT_CACHE_SIZE results are kept in memory (0 disables the cache) and, if
+# RESULT_CACHE_DB is set, up to RESULT_CACHE_DISK_SIZE in a sqlite file that
+# survives restarts. Results expire after RESULT_CACHE_TTL_S seconds.
+RESULT_CACHE_SIZE = _env_int('LUNG_RESULT_CACHE_SIZE', 1024)
+RESULT_CACHE_TTL_S = _env_float('LUNG_RESULT_CACHE_TTL_S', 3600.0)
+RESULT_CACHE_DB = os.environ.get('LUNG_RESULT_CACHE_DB', '')
+RESULT_CACHE_DISK_SIZE = _env_int('LUNG_RESULT_CACHE_DISK_SIZE', 100000)
+
+# Heatmap storage: "disk" writes overlays to static/heatmaps/generated (kept
+# apart from the files tracked in static/heatmaps) and deletes the oldest beyond HEATMAP_MAX_FILES files, HEATMAP_MAX_MB megabytes or
+# HEATMAP_MAX_AGE_S seconds (0 disables a limit; a sweeper runs every
+# HEATMAP_SWEEP_INTERVAL_S). "memory" keeps them in a bounded in-process store
+# instead, and "inline" returns them as data URIs. Browsers may cache served
+# heatmaps for HEATMAP_HTTP_MAX_AGE_S seconds since their names never repeat.
+HEATMAP_STORE = os.environ.get('LUNG_HEATMAP_STORE', 'disk')
+HEATMAP_MAX_FILES = _env_int('LUNG_HEATMAP_MAX_FILES', 1000)
+HEATMAP_MAX_MB = _env_int('LUNG_HEATMAP_MAX_MB', 500)
+HEATMAP_MAX_AGE_S = _env_float('LUNG_HEATMAP_MAX_AGE_S', 24 * 3600.0)
+HEATMAP_SWEEP_INTERVAL_S = _env_float('LUNG_HEATMAP_SWEEP_INTERVAL_S', 60.0)
+HEATMAP_HTTP_MAX_AGE_S = _env_int('LUNG_HEATMAP_HTTP_MAX_AGE_S', 24 * 3600)
+
+# Heatmap rendering: overlays are blended with HEATMAP_ALPHA of an OpenCV
+# colormap (e.g. "jet", "turbo", "inferno") and encoded as HEATMAP_FORMAT
+# ("jpg", "webp" or "png") at HEATMAP_QUALITY (jpg/webp), optionally as
+# progressive JPEG. The returned overlay is at most HEATMAP_MAX_SIZE pixels on
+# its longest side (0 = original size); HEATMAP_THUMBNAIL_SIZE > 0 also
+# renders a thumbnail from the same Grad-CAM.
+HEATMAP_ALPHA = _env_float('LUNG_HEATMAP_ALPHA', 0.4)
+HEATMAP_COLORMAP = os.environ.get('LUNG_HEATMAP_COLORMAP', 'jet')
+HEATMAP_FORMAT = os.environ.get('LUNG_HEATMAP_FORMAT', 'jpg')
+HEATMAP_QUALITY = _env_int('LUNG_HEATMAP_QUALITY', 95)
+HEATMAP_PROGRESSIVE = _env_int('LUNG_HEATMAP_PROGRESSIVE', 0) == 1
+HEATMAP_MAX_SIZE = _env_int('LUNG_HEATMAP_MAX_SIZE', 1024)
+HEATMAP_THUMBNAIL_SIZE = _env_int('LUNG_HEATMAP_THUMBNAIL_SIZE', 0)
+
+# /predict_batch: uploads up to BATCH_MAX_UPLOAD_MB, decoded and classified
+# BATCH_CHUNK_SIZE images at a time
+BATCH_MAX_UPLOAD_MB = _env_int('LUNG_BATCH_MAX_UPLOAD_MB', 512)
+BATCH_CHUNK_SIZE = _env_int('LUNG_BATCH_CHUNK_SIZE', 32)
+
+# /predict_study: DICOM files and zipped series. Slices are decoded and
+# classified STUDY_BATCH_SIZE at a time; STUDY_TOP_K most suspicious slices
+# are returned with heatmaps. CT slices are shown through the
+# DICOM_WINDOW_CENTER / DICOM_WINDOW_WIDTH window (Hounsfield units).
+STUDY_BATCH_SIZE = _env_int('LUNG_STUDY_BATCH_SIZE', 16)
+STUDY_TOP_K = _env_int('LUNG_STUDY_TOP_K', 5)
+DICOM_WINDOW_CENTER = _env_float('LUNG_DICOM_WINDOW_CENTER', -600.0)
+DICOM_WINDOW_WIDTH = _env_float('LUNG_DICOM_WINDOW_WIDTH', 1500.0)
+
+# /jobs: the diagnosis is returned at once and the heatmap rendered by
+# JOB_WORKERS background threads. At most JOB_MAX jobs are kept; finished
+# ones expire JOB_TTL_S seconds after their heatmap is done.
+JOB_MAX = _env_int('LUNG_JOB_MAX', 1000)
+JOB_TTL_S = _env_float('LUNG_JOB_TTL_S', 600.0)
+JOB_WORKERS = _env_int('LUNG_JOB_WORKERS', 2)
+
+# Admission control of the classification endpoints (per process). At most
+# ADMISSION_MAX_IN_FLIGHT requests are processed at once and at most
+# ADMISSION_MAX_PER_CLIENT per client (the ADMISSION_CLIENT_HEADER header if
+# set, else the remote address); others get 429 with Retry-After. From
+# DEGRADE_ENSEMBLE_AT requests in flight only one model runs per request,
+# from DEGRADE_HEATMAP_AT Grad-CAM is skipped too. 0 disables a limit.
+ADMISSION_MAX_IN_FLIGHT = _env_int('LUNG_ADMISSION_MAX_IN_FLIGHT', 32)
+ADMISSION_MAX_PER_CLIENT = _env_int('LUNG_ADMISSION_MAX_PER_CLIENT', 8)
+ADMISSION_CLIENT_HEADER = os.environ.get('LUNG_ADMISSION_CLIENT_HEADER', '')
+ADMISSION_RETRY_AFTER_S = _env_int('LUNG_ADMISSION_RETRY_AFTER_S', 1)
+DEGRADE_ENSEMBLE_AT = _env_int('LUNG_DEGRADE_ENSEMBLE_AT', 16)
+DEGRADE_HEATMAP_AT = _env_int('LUNG_DEGRADE_HEATMAP_AT', 24)
+
+# serve.py: WORKERS processes (0 = one per WORKER_CORES cores), each handling
+# WORKER_THREADS concurrent requests so the scheduler can batch them. With
+# PIN_WORKERS each worker is pinned to its own share of the cores.
+WORKERS = _env_int('LUNG_WORKERS', 0)
+WORKER_CORES = _env_int('LUNG_WORKER_CORES', 4)
+WORKER_THREADS = _env_int('LUNG_WORKER_THREADS', 8)
+WORKER_TIMEOUT_S = _env_int('LUNG_WORKER_TIMEOUT_S', 300)
+PIN_WORKERS = _env_int('LUNG_PIN_WORKERS', 1) == 1
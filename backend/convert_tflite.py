@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from image_processor import CT_CLASSES
+from model_builders import MODEL_SPECS, MODELS_DIR, load_model
+from scan_image import ScanImage
+from tflite_engine import QUANTIZATIONS, TFLiteModel, convert_model, tflite_path
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Class names in output-index order; binary models map score > 0.5 to index 1
+MODEL_CLASSES = {
+    'scan_classifier': ['ct', 'xray'],
+    'ct_efficientnetv2s': CT_CLASSES,
+    'ct_resnet50': CT_CLASSES,
+    'xray_mobilenetv2': ['normal', 'pneumonia'],
+    'xray_vgg16': ['normal', 'pneumonia'],
+}
+
+
+def find_images(directory, limit=None):
+    """Image paths under ``directory`` with the name of their parent folder as label."""
+    images = []
+    for root, _, files in os.walk(directory):
+        for filename in sorted(files):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                images.append((os.path.join(root, filename), os.path.basename(root)))
+    images.sort()
+    return images[:limit] if limit else images
+
+
+def load_tensors(images):
+    """uint8 images at the models' input size, stacked into one batch."""
+    return np.concatenate([ScanImage.from_path(path).pixels for path, _ in images], axis=0)
+
+
+def predicted_classes(outputs):
+    if outputs.shape[-1] == 1:
+        return (outputs[:, 0] > 0.5).astype(int)
+    return np.argmax(outputs, axis=-1)
+
+
+def time_per_image(predict_fn, tensors):
+    """Mean single-image latency in milliseconds, after one warm-up call."""
+    predict_fn(tensors[:1])
+    start = time.perf_counter()
+    outputs = [predict_fn(tensors[i:i + 1]) for i in range(len(tensors))]
+    elapsed = (time.perf_counter() - start) * 1000.0 / len(tensors)
+    return np.concatenate(outputs, axis=0), elapsed
+
+
+def compare(model_name, keras_model, tflite_model, tensors, labels):
+    keras_outputs, keras_ms = time_per_image(keras_model.predict_on_batch, tensors)
+    tflite_outputs, tflite_ms = time_per_image(tflite_model.predict_on_batch, tensors)
+    keras_classes = predicted_classes(np.asarray(keras_outputs))
+    tflite_classes = predicted_classes(tflite_outputs)
+
+    report = {
+        'images': len(tensors),
+        'size_mb': round(tflite_model.size_bytes / (1024 * 1024), 2),
+        'keras_ms_per_image': round(keras_ms, 2),
+        'tflite_ms_per_image': round(tflite_ms, 2),
+        'speedup': round(keras_ms / tflite_ms, 2) if tflite_ms else None,
+        'agreement_with_keras': float(np.mean(keras_classes == tflite_classes)),
+        'max_abs_output_diff': float(np.max(np.abs(np.asarray(keras_outputs) - tflite_outputs))),
+    }
+
+    # Accuracy against ground truth when images sit in folders named after their class
+    classes = MODEL_CLASSES[model_name]
+    labelled = [i for i, label in enumerate(labels) if label in classes]
+    if labelled:
+        truth = np.array([classes.index(labels[i]) for i in labelled])
+        report['labelled_images'] = len(labelled)
+        report['keras_accuracy'] = float(np.mean(keras_classes[labelled] == truth))
+        report['tflite_accuracy'] = float(np.mean(tflite_classes[labelled] == truth))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert models to quantized TFLite and compare them with the Keras reference models."
+    )
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--models', nargs='+', default=list(MODEL_SPECS), choices=list(MODEL_SPECS))
+    parser.add_argument('--quantization', nargs='+', default=list(QUANTIZATIONS), choices=QUANTIZATIONS)
+    parser.add_argument('--calibration-dir', help="Images used to calibrate int8 activation ranges")
+    parser.add_argument('--calibration-size', type=int, default=200)
+    parser.add_argument('--eval-dir', help="Images used for the accuracy/latency comparison "
+                                           "(class subfolders enable accuracy against labels)")
+    parser.add_argument('--eval-size', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=None, help="Interpreter threads during evaluation")
+    parser.add_argument('--report', default='tflite_report.json')
+    args = parser.parse_args()
+
+    calibration = None
+    if args.calibration_dir:
+        calibration = load_tensors(find_images(args.calibration_dir, args.calibration_size))
+    eval_images = find_images(args.eval_dir, args.eval_size) if args.eval_dir else []
+    eval_tensors = load_tensors(eval_images) if eval_images else None
+    eval_labels = [label for _, label in eval_images]
+
+    report = {}
+    for model_name in args.models:
+        keras_model = load_model(model_name, args.models_dir)
+        report[model_name] = {}
+        for quantization in args.quantization:
+            if quantization == 'int8' and calibration is None:
+                print(f"Skipping int8 for {model_name}: no --calibration-dir given")
+                continue
+            path = tflite_path(model_name, quantization, args.models_dir)
+            with open(path, 'wb') as f:
+                f.write(convert_model(keras_model, quantization, calibration))
+            print(f"Wrote {path}")
+
+            if eval_tensors is not None:
+                tflite_model = TFLiteModel(path, num_threads=args.threads)
+                report[model_name][quantization] = compare(
+                    model_name, keras_model, tflite_model, eval_tensors, eval_labels
+                )
+                print(f"{model_name} [{quantization}]: {report[model_name][quantization]}")
+
+    if eval_tensors is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Comparison report written to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
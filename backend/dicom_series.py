@@ -0,0 +1,225 @@
+import io
+import zipfile
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+import config
+from metrics import METRICS
+from scan_image import ScanImage
+
+# Window (center, width) in Hounsfield units applied to CT slices
+LUNG_WINDOW = (config.DICOM_WINDOW_CENTER, config.DICOM_WINDOW_WIDTH)
+
+MODALITY_SCAN_TYPES = {
+    'CT': 'ct',
+    'CR': 'xray',
+    'DX': 'xray',
+}
+
+
+def is_dicom(data):
+    """Whether ``data`` starts like a DICOM Part 10 file."""
+    return len(data) >= 132 and data[128:132] == b'DICM'
+
+
+def _read_dataset(fileobj, **kwargs):
+    try:
+        return pydicom.dcmread(fileobj, **kwargs)
+    except (InvalidDicomError, EOFError, ValueError) as e:
+        raise ValueError(f"Could not read DICOM file: {str(e)}")
+
+
+def _pixel_array(ds):
+    try:
+        return ds.pixel_array
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+        raise ValueError(f"Could not decode DICOM pixel data: {str(e)}")
+
+
+def window_slice(ds, pixels, window=LUNG_WINDOW):
+    """Map one frame of stored ``pixels`` to a uint8 image.
+
+    CT frames are rescaled to Hounsfield units and clipped to ``window``;
+    other modalities use their own window tags, or their full range.
+    """
+    values = pixels.astype(np.float32)
+    values *= float(getattr(ds, 'RescaleSlope', 1) or 1)
+    values += float(getattr(ds, 'RescaleIntercept', 0) or 0)
+
+    if getattr(ds, 'Modality', None) == 'CT' and window is not None:
+        center, width = window
+    elif 'WindowCenter' in ds and 'WindowWidth' in ds:
+        center = float(np.atleast_1d(ds.WindowCenter)[0])
+        width = float(np.atleast_1d(ds.WindowWidth)[0])
+    else:
+        low, high = float(values.min()), float(values.max())
+        center, width = (low + high) / 2, max(high - low, 1.0)
+
+    low = center - width / 2
+    values -= low
+    values *= 255.0 / width
+    np.clip(values, 0, 255, out=values)
+    image = values.astype(np.uint8)
+    if getattr(ds, 'PhotometricInterpretation', '') == 'MONOCHROME1':
+        image = 255 - image
+    return image
+
+
+class _Slice:
+    def __init__(self, sort_key, instance_number, load):
+        self.sort_key = sort_key
+        self.instance_number = instance_number
+        self.load = load
+
+
+def _instance_number(ds):
+    instance = getattr(ds, 'InstanceNumber', None)
+    return int(instance) if instance not in (None, '') else None
+
+
+def _sort_key(ds, fallback):
+    position = getattr(ds, 'ImagePositionPatient', None)
+    if position is not None and len(position) == 3:
+        return (0, float(position[2]), fallback)
+    instance = _instance_number(ds)
+    if instance is not None:
+        return (1, instance, fallback)
+    return (2, 0, fallback)
+
+
+class DicomSeries:
+    """The slices of a DICOM upload, decoded one at a time on demand.
+
+    A single file may hold one frame or a multi-frame volume; uncompressed
+    pixel data is viewed in place in the upload rather than copied, and each
+    frame is windowed only when it is reached. A zip holds one file per
+    slice: only the headers are read to order the slices, and each slice's
+    pixels are read when it is reached.
+    """
+
+    def __init__(self, slices, modality, window=LUNG_WINDOW, archive=None):
+        self.slices = sorted(slices, key=lambda s: s.sort_key)
+        self.modality = modality
+        self.window = window
+        self._archive = archive
+
+    @property
+    def scan_type(self):
+        """``ct`` or ``xray`` from the Modality tag, None when it does not say."""
+        return MODALITY_SCAN_TYPES.get(self.modality)
+
+    def __len__(self):
+        return len(self.slices)
+
+    @classmethod
+    def from_bytes(cls, data, window=LUNG_WINDOW):
+        """Series of one DICOM file (single- or multi-frame)."""
+        # Only the header is parsed; the file position is left at the pixel data
+        fp = io.BytesIO(data)
+        ds = _read_dataset(fp, stop_before_pixels=True)
+        frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+        volume = cls._uncompressed_frames(ds, data, fp.tell(), frames)
+        decoded = []
+
+        def load(frame):
+            def load_frame():
+                if volume is not None:
+                    return window_slice(ds, volume[frame], window)
+                # Encapsulated (compressed) pixel data: decoded once by pydicom
+                if not decoded:
+                    decoded.append(_pixel_array(_read_dataset(io.BytesIO(data))))
+                pixels = decoded[0][frame] if frames > 1 else decoded[0]
+                return window_slice(ds, pixels, window)
+            return load_frame
+
+        instance = _instance_number(ds)
+        slices = [_Slice((frame,), instance if frames == 1 else frame + 1, load(frame)) for frame in range(frames)]
+        return cls(slices, getattr(ds, 'Modality', None), window)
+
+    @staticmethod
+    def _uncompressed_frames(ds, data, offset, frames):
+        """``(frames, rows, columns)`` view of uncompressed pixel data starting at ``offset`` in ``data``, else None."""
+        syntax = ds.file_meta.get('TransferSyntaxUID')
+        if syntax is None or syntax.is_compressed or not syntax.is_little_endian:
+            return None
+        if getattr(ds, 'SamplesPerPixel', 1) != 1 or getattr(ds, 'BitsAllocated', None) not in (8, 16):
+            return None
+        # Pixel Data element header: tag, then VR and a 4-byte length (explicit VR) or just the length
+        if data[offset:offset + 4] != b'\xe0\x7f\x10\x00':
+            return None
+        offset += 8 if syntax.is_implicit_VR else 12
+        dtype = np.dtype(f"<{'i' if ds.PixelRepresentation else 'u'}{ds.BitsAllocated // 8}")
+        count = frames * ds.Rows * ds.Columns
+        if offset + count * dtype.itemsize > len(data):
+            return None
+        return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(frames, ds.Rows, ds.Columns)
+
+    @classmethod
+    def from_zip(cls, fileobj, window=LUNG_WINDOW):
+        """Series of a zip with one DICOM file per slice."""
+        archive = zipfile.ZipFile(fileobj)
+        slices = []
+        modality = None
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as member:
+                try:
+                    header = pydicom.dcmread(member, stop_before_pixels=True)
+                except (InvalidDicomError, EOFError, ValueError):
+                    continue
+            modality = modality or getattr(header, 'Modality', None)
+
+            def load(info=info):
+                ds = _read_dataset(io.BytesIO(archive.read(info)))
+                return window_slice(ds, _pixel_array(ds), window)
+
+            slices.append(_Slice(_sort_key(header, info.filename), _instance_number(header), load))
+        if not slices:
+            archive.close()
+            raise ValueError("No DICOM slices found in the archive")
+        return cls(slices, modality, window, archive)
+
+    def scan_images(self):
+        """Yield ``(slice_index, instance_number, ScanImage)`` in slice order, decoding lazily."""
+        for index, dicom_slice in enumerate(self.slices):
+            with METRICS.time('lung_stage_seconds', stage='dicom_decode'):
+                scan_image = ScanImage.from_array(dicom_slice.load())
+            yield index, dicom_slice.instance_number, scan_image
+
+    def batches(self, batch_size):
+        """:meth:`scan_images` in lists of at most ``batch_size`` slices."""
+        batch = []
+        for item in self.scan_images():
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+
+def open_series(data, window=LUNG_WINDOW):
+    """DicomSeries of an uploaded DICOM file or zip of DICOM files."""
+    if is_dicom(data):
+        return DicomSeries.from_bytes(data, window)
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        return DicomSeries.from_zip(io.BytesIO(data), window)
+    raise ValueError("Upload is neither a DICOM file nor a zip of DICOM files")
+
+
+def decode_image(data, window=LUNG_WINDOW):
+    """ScanImage of PNG/JPEG bytes or of a single-frame DICOM file."""
+    if not is_dicom(data):
+        return ScanImage.from_bytes(data)
+    series = DicomSeries.from_bytes(data, window)
+    if len(series) != 1:
+        raise ValueError("Multi-frame DICOM files have to be sent to /predict_study")
+    return next(series.scan_images())[2]
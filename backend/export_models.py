@@ -0,0 +1,41 @@
+import argparse
+import os
+import time
+
+from model_builders import MODEL_SPECS, MODELS_DIR, artifact_path
+
+
+def export_model(model_name, models_dir, saved_model=False):
+    builder, weights_file = MODEL_SPECS[model_name]
+    start = time.perf_counter()
+    model = builder()
+    model.load_weights(os.path.join(models_dir, weights_file))
+    path = artifact_path(model_name, models_dir)
+    model.save(path)
+    print(f"Exported {model_name} to {path} in {time.perf_counter() - start:.2f}s")
+    if saved_model:
+        # Serving signature takes uint8 images of any size, like the .keras artifact
+        saved_model_path = os.path.join(models_dir, 'saved_model', model_name)
+        model.save(saved_model_path, save_format='tf')
+        print(f"Exported {model_name} to {saved_model_path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serialize each model (architecture, in-graph preprocessing and fine-tuned weights) into "
+                    "one .keras artifact so that the server loads it in a single read, without building the "
+                    "backbone first."
+    )
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--models', nargs='+', default=list(MODEL_SPECS), choices=list(MODEL_SPECS))
+    parser.add_argument('--saved-model', action='store_true',
+                        help="Also write a TensorFlow SavedModel per model under <models-dir>/saved_model")
+    args = parser.parse_args()
+
+    for model_name in args.models:
+        export_model(model_name, args.models_dir, args.saved_model)
+
+
+if __name__ == '__main__':
+    main()
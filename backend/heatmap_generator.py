@@ -1,14 +1,15 @@
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras.preprocessing import image
-import cv2
-import base64
+import logging
 import os
-import uuid
-from datetime import datetime
+from heatmap_store import HeatmapStore
+from metrics import METRICS
+from overlay_renderer import OverlayRenderer
+
+logger = logging.getLogger(__name__)
 
 class HeatmapGenerator:
-    def __init__(self):
+    def __init__(self, store=None, renderer=None, sizes=None):
         self.model_layers = {
             'ct_efficientnetv2s': 'top_conv',  # For EfficientNetV2S
             'ct_resnet50': 'conv5_block3_out',       # For ResNet50
@@ -20,136 +21,136 @@ class HeatmapGenerator:
         current_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory containing this file
         self.static_dir = os.path.join(current_dir, 'static', 'heatmaps')
         os.makedirs(self.static_dir, exist_ok=True)
-        print(f"Static directory created at: {self.static_dir}")
+        # Where encoded overlays go (bounded directory, memory or inline)
+        self.store = store if store is not None else HeatmapStore(os.path.join(self.static_dir, 'generated'))
+        # Blends and encodes overlays; ``sizes`` maps each rendered variant to
+        # its maximum longest side ("full" is the one returned as visualization)
+        self.renderer = renderer if renderer is not None else OverlayRenderer()
+        self.sizes = sizes if sizes is not None else {'full': 0}
+        # Traced prediction + Grad-CAM functions, one per model, built by
+        # add_model on the model's first Grad-CAM pass (at startup warm-up for
+        # the models warmed up with LUNG_WARMUP_INFERENCE)
+        self.fused_functions = {}
+
+    def add_model(self, model_type, model):
+        layer_name = self.model_layers[model_type]
+        grad_model = tf.keras.models.Model(
+            [model.inputs],
+            [model.get_layer(layer_name).output, model.output]
+        )
+        fused = self._make_fused_function(grad_model)
+        self.fused_functions[model_type] = fused
+        logger.info("Fused Grad-CAM function built for: %s", model_type)
+        return fused
+
+    def remove_model(self, model_type):
+        """Drop the fused function of a model that was unloaded."""
+        self.fused_functions.pop(model_type, None)
+
+    @staticmethod
+    def _make_fused_function(grad_model):
+        @tf.function(input_signature=[tf.TensorSpec([None, None, None, 3], tf.uint8)])
+        def fused(img_array):
+            with tf.GradientTape() as tape:
+                conv_outputs, predictions = grad_model(img_array, training=False)
+                class_idx = tf.argmax(predictions, axis=-1)
+                # Score of each image's own predicted class
+                loss = tf.gather(predictions, class_idx, axis=1, batch_dims=1)
+
+            grads = tape.gradient(loss, conv_outputs)
+            pooled_grads = tf.reduce_mean(grads, axis=(1, 2), keepdims=True)
+            heatmap = tf.reduce_mean(pooled_grads * conv_outputs, axis=-1)
+            heatmap = tf.nn.relu(heatmap)
+            heatmap = tf.math.divide_no_nan(heatmap, tf.reduce_max(heatmap, axis=(1, 2), keepdims=True))
+            return predictions, heatmap
+
+        return fused
+
+    def predict_with_heatmap(self, model_type, img_array, model):
+        """Return ``(predictions, heatmaps)`` for a batch from one fused forward/backward pass."""
+        fused = self.fused_functions.get(model_type)
+        if fused is None:
+            fused = self.add_model(model_type, model)
+        predictions, heatmaps = fused(tf.convert_to_tensor(img_array, tf.uint8))
+        return predictions.numpy(), heatmaps.numpy()
 
     def get_heatmap(self, model, img_array, last_conv_layer_name):
         try:
-            print(f"\nGetting heatmap for layer: {last_conv_layer_name}")
-            print(f"Model input shape: {model.input_shape}")
-            print(f"Model output shape: {model.output_shape}")
+            logger.debug("Getting heatmap for layer: %s", last_conv_layer_name)
             
             # Create a model that maps the input image to the activations of the last conv layer
             grad_model = tf.keras.models.Model(
                 [model.inputs],
                 [model.get_layer(last_conv_layer_name).output, model.output]
             )
-            print(f"Grad model created successfully")
 
             # Get the gradient of the predicted class with respect to the output feature map
             with tf.GradientTape() as tape:
                 conv_outputs, predictions = grad_model(img_array)
-                print(f"Conv outputs shape: {conv_outputs.shape}")
-                print(f"Predictions shape: {predictions.shape}")
-                
                 class_idx = tf.argmax(predictions[0])
-                print(f"Predicted class index: {class_idx}")
                 loss = predictions[:, class_idx]
-                print(f"Loss shape: {loss.shape}")
 
             # Get the gradients of the loss with respect to the output feature map
             grads = tape.gradient(loss, conv_outputs)
-            print(f"Gradients shape: {grads.shape}")
 
             # Generate the heatmap
             pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-            print(f"Pooled gradients shape: {pooled_grads.shape}")
             
             heatmap = tf.reduce_mean(tf.multiply(pooled_grads, conv_outputs), axis=-1)
             heatmap = np.maximum(heatmap, 0)
             heatmap /= np.max(heatmap)
-            print(f"Final heatmap shape: {heatmap.shape}")
 
             return heatmap[0]
         except Exception as e:
-            print(f"Error generating heatmap: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error generating heatmap: %s", e)
             return None
 
-    def apply_heatmap(self, img_path, heatmap, alpha=0.4):
-        try:
-            # Load the original image
-            img = cv2.imread(img_path)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # Resize heatmap to match image size
-            heatmap = cv2.resize(heatmap, (img.shape[1], img.shape[0]))
-            
-            # Convert heatmap to RGB
-            heatmap = np.uint8(255 * heatmap)
-            heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-            
-            # Superimpose the heatmap on original image
-            superimposed_img = heatmap * alpha + img
-            superimposed_img = np.clip(superimposed_img, 0, 255).astype(np.uint8)
-            
-            return superimposed_img
-        except Exception as e:
-            print(f"Error applying heatmap: {str(e)}")
-            return None
+    def generate_visualization(self, model, scan_image, model_type, heatmap=None):
+        """Overlay a Grad-CAM heatmap on ``scan_image`` and save every size variant.
 
-    def generate_visualization(self, model, img_path, model_type):
+        Returns ``{variant: reference}`` (always including ``"full"``) or None.
+        Pass the ``heatmap`` returned by :meth:`predict_with_heatmap` to skip
+        recomputing it.
+        """
         try:
-            print(f"\nGenerating visualization for model type: {model_type}")
-            print(f"Image path: {img_path}")
-            print(f"Static directory path: {self.static_dir}")
-            print(f"Directory exists: {os.path.exists(self.static_dir)}")
-            print(f"Directory is writable: {os.access(self.static_dir, os.W_OK)}")
+            logger.debug("Generating visualization for model type: %s", model_type)
             
-            # Load and preprocess image
-            img = image.load_img(img_path, target_size=(224, 224))
-            img_array = image.img_to_array(img) / 255.0
-            img_array = np.expand_dims(img_array, axis=0)
-            print(f"Image array shape: {img_array.shape}")
+            # Reuse the pixels decoded once for the whole pipeline
+            img_array = scan_image.pixels
 
             # Get the last conv layer name for the model
             last_conv_layer = self.model_layers.get(model_type)
             if not last_conv_layer:
-                print(f"No layer mapping found for model type: {model_type}")
+                logger.warning("No layer mapping found for model type: %s", model_type)
                 return None
-            print(f"Using layer: {last_conv_layer}")
 
-            # Generate heatmap
-            heatmap = self.get_heatmap(model, img_array, last_conv_layer)
+            # Generate heatmap unless the fused pass already produced it
             if heatmap is None:
-                print("Failed to generate heatmap")
-                return None
-            print(f"Heatmap shape: {heatmap.shape}")
-
-            # Apply heatmap to original image
-            visualization = self.apply_heatmap(img_path, heatmap)
-            if visualization is None:
-                print("Failed to apply heatmap")
+                with METRICS.time('lung_stage_seconds', stage='gradcam'):
+                    heatmap = self.predict_with_heatmap(model_type, img_array, model)[1][0]
+            if heatmap is None:
+                logger.warning("Failed to generate heatmap")
                 return None
-            print(f"Visualization shape: {visualization.shape}")
-
-            # Generate unique filename
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            unique_id = str(uuid.uuid4())[:8]
-            filename = f'heatmap_{timestamp}_{unique_id}.jpg'
-            filepath = os.path.join(self.static_dir, filename)
-            print(f"Saving heatmap to: {filepath}")
-
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-            # Save the visualization
+            # Blend, encode and store every variant, each downscaled from the previous one
+            references = {}
+            source = scan_image.original
+            plan = self.renderer.plan(scan_image.height, scan_image.width, self.sizes)
             try:
-                cv2.imwrite(filepath, cv2.cvtColor(visualization, cv2.COLOR_RGB2BGR))
-                print(f"File saved successfully")
-                print(f"File exists: {os.path.exists(filepath)}")
-                print(f"File size: {os.path.getsize(filepath)} bytes")
+                for slot, (name, (height, width)) in enumerate(plan):
+                    with METRICS.time('lung_stage_seconds', stage='overlay'):
+                        overlay, source = self.renderer.blend(source, heatmap, height, width, slot=str(slot))
+                    with METRICS.time('lung_stage_seconds', stage='encode'):
+                        data = self.renderer.encode(overlay)
+                    with METRICS.time('lung_stage_seconds', stage='store'):
+                        references[name] = self.store.save(data, self.renderer.extension)
             except Exception as save_error:
-                print(f"Error saving file: {str(save_error)}")
+                logger.error("Error saving file: %s", save_error)
                 return None
             
-            # Return the relative URL path
-            url_path = f'/static/heatmaps/{filename}'
-            print(f"Returning URL path: {url_path}")
-            return url_path
+            # Relative URL paths (or data URIs in inline mode) per variant
+            return references
 
         except Exception as e:
-            print(f"Error in visualization generation: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error in visualization generation: %s", e)
             return None 
\ No newline at end of file
@@ -0,0 +1,185 @@
+import base64
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+URL_PREFIX = '/static/heatmaps/'
+
+MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+STORE_MODES = ('disk', 'memory', 'inline')
+
+
+class HeatmapStore:
+    """Bounded storage for encoded heatmap overlays.
+
+    ``disk`` writes files into ``directory``, which it owns: every file in
+    it is indexed at startup and may be evicted. It keeps at most ``max_files``
+    files / ``max_bytes`` bytes, none older than ``max_age_seconds``; the
+    oldest are deleted on write and by a background sweeper. ``memory`` keeps
+    overlays served by ``serve_heatmap`` in process under the same limits.
+    Entries stay in insertion order, so the oldest is always evicted first
+    and reads never extend an overlay's lifetime. ``inline`` stores nothing
+    and returns the overlay as a data URI.
+    """
+
+    def __init__(self, directory, mode='disk', max_files=1000, max_bytes=500 * 1024 * 1024,
+                 max_age_seconds=24 * 3600, sweep_interval_seconds=60):
+        if mode not in STORE_MODES:
+            raise ValueError(f"Unknown heatmap store mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age_seconds
+        self.sweep_interval = sweep_interval_seconds
+        # filename -> (size, created) for disk, filename -> (data, created) for memory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._evictions = 0
+        self._sweeper = None
+        if mode == 'disk':
+            os.makedirs(directory, exist_ok=True)
+            self._index_directory()
+
+    def _index_directory(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for created, name, size in sorted(files):
+            self._entries[name] = (size, created)
+            self._bytes += size
+
+    @staticmethod
+    def new_filename(extension):
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        unique_id = str(uuid.uuid4())[:8]
+        return f'heatmap_{timestamp}_{unique_id}.{extension}'
+
+    def save(self, data, extension='jpg'):
+        """Store encoded overlay ``data`` and return the reference handed to clients."""
+        if self.mode == 'inline':
+            encoded = base64.b64encode(data).decode('ascii')
+            return f'data:{MIME_TYPES[extension]};base64,{encoded}'
+
+        filename = self.new_filename(extension)
+        if self.mode == 'disk':
+            with open(os.path.join(self.directory, filename), 'wb') as f:
+                f.write(data)
+            entry = (len(data), time.time())
+        else:
+            entry = (data, time.time())
+        with self._lock:
+            self._entries[filename] = entry
+            self._bytes += len(data)
+            evicted = self._evict(time.time())
+        self._delete_files(evicted)
+        return URL_PREFIX + filename
+
+    def _size(self, entry):
+        value = entry[0]
+        return value if isinstance(value, int) else len(value)
+
+    def _expired(self, entry, now):
+        return self.max_age > 0 and now - entry[1] > self.max_age
+
+    def _evict(self, now):
+        """Pop entries over the limits (oldest first); return the popped filenames."""
+        evicted = []
+        while self._entries:
+            name, entry = next(iter(self._entries.items()))
+            too_old = self._expired(entry, now)
+            too_many = self.max_files > 0 and len(self._entries) > self.max_files
+            too_big = self.max_bytes > 0 and self._bytes > self.max_bytes
+            if not (too_old or too_many or too_big):
+                break
+            self._entries.popitem(last=False)
+            self._bytes -= self._size(entry)
+            self._evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def _delete_files(self, filenames):
+        if self.mode != 'disk':
+            return
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self):
+        """Evict everything past its age limit (and anything over the size limits)."""
+        with self._lock:
+            evicted = self._evict(time.time())
+        self._delete_files(evicted)
+        return len(evicted)
+
+    def start_sweeper(self):
+        if self.mode == 'inline' or self._sweeper is not None or self.sweep_interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error("Error sweeping heatmaps: %s", e)
+
+        self._sweeper = threading.Thread(target=run, name="heatmap-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def get(self, filename):
+        """Overlay bytes of ``filename`` in memory mode, or None once it is past its age limit."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or self.mode != 'memory' or self._expired(entry, time.time()):
+                return None
+            return entry[0]
+
+    def contains(self, reference):
+        """Whether ``reference`` (as returned by :meth:`save`) can still be served."""
+        if not reference:
+            return False
+        if reference.startswith('data:'):
+            return True
+        if not reference.startswith(URL_PREFIX):
+            return False
+        filename = reference[len(URL_PREFIX):]
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None:
+                return not self._expired(entry, time.time())
+        # Another worker process may have written it into the shared directory
+        return self.mode == 'disk' and os.path.isfile(os.path.join(self.directory, filename))
+
+    @staticmethod
+    def mime_type(filename):
+        return MIME_TYPES.get(filename.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'evictions': self._evictions,
+                'max_files': self.max_files,
+                'max_bytes': self.max_bytes,
+                'max_age_s': self.max_age,
+            }
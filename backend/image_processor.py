@@ -1,155 +1,451 @@
+import heapq
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Input, Dropout, BatchNormalization
-from tensorflow.keras.applications import MobileNetV2, ResNet50, EfficientNetV2S, VGG16
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.preprocessing import image
+import logging
 import os
+import time
 from heatmap_generator import HeatmapGenerator
+from scan_image import ScanImage
+from dicom_series import decode_image
+from batch_scheduler import MicroBatchScheduler
+from model_builders import INPUT_SHAPE, MODEL_SPECS, build_ensemble, fit_input_size, load_model
+from compiled_model import CompiledModel
+from model_registry import ModelRegistry
+from tflite_engine import load_tflite_model
+from result_cache import ResultCache
+from heatmap_store import HeatmapStore
+from overlay_renderer import OverlayRenderer
+from metrics import METRICS
+import config
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Disease models available for each scan type, cheapest first
+SCAN_MODELS = {
+    'ct': ('ct_efficientnetv2s', 'ct_resnet50'),
+    'xray': ('xray_mobilenetv2', 'xray_vgg16'),
+}
+
+# Keys under which each model's prediction is reported in ``all_predictions``
+PREDICTION_KEYS = {
+    'ct_efficientnetv2s': 'efficientnet',
+    'ct_resnet50': 'resnet50',
+    'xray_mobilenetv2': 'mobilenet',
+    'xray_vgg16': 'vgg16',
+}
+
+# Scheduler queue suffix for the fused prediction + Grad-CAM pass of a model
+GRADCAM_SUFFIX = ':gradcam'
+
+# Registry suffix of the Keras model kept for Grad-CAM when a model is served by TFLite
+KERAS_SUFFIX = ':keras'
+
+CT_CLASSES = ['Adenocarcinoma', 'Large Cell Carcinoma', 'Squamous Cell Carcinoma', 'normal']
+XRAY_CLASSES = ['pneumonia', 'normal']
+
+# Cascade order per scan type, the cheapest-first order of SCAN_MODELS: the
+# first model always runs, the second only when the first is not confident enough
+CASCADES = SCAN_MODELS
+
+# Registry names of the graphs running both models of a scan type side by
+# side (see build_ensemble), and their members in output order
+ENSEMBLES = {f'ensemble_{scan_type}': models for scan_type, models in SCAN_MODELS.items()}
+
+# Key of an ensemble graph's fused diagnosis in ``all_predictions``
+ENSEMBLE_KEY = 'ensemble'
+
+# Older model names still accepted from clients
+MODEL_ALIASES = {
+    'ct_efficientnetb0': 'ct_efficientnetv2s',
+}
 
 class ImageProcessor:
     def __init__(self):
         try:
-            # Define the scan type classifier model architecture
-            def create_scan_classifier():
-                input_tensor = Input(shape=(224, 224, 3))
-                base_model = MobileNetV2(weights='imagenet', include_top=False, input_tensor=input_tensor)
-                x = base_model.output
-                x = GlobalAveragePooling2D()(x)
-                x = Dropout(0.3)(x)
-                output = Dense(1, activation='sigmoid')(x)
-                model = Model(inputs=input_tensor, outputs=output)
-                model.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
-                return model
-
-            # Define CT model builder
-            def build_ct_model(base_model, num_classes=4):
-                x = base_model.output
-                x = GlobalAveragePooling2D()(x)
-                x = BatchNormalization()(x)
-                x = Dropout(0.4)(x)
-                output = Dense(num_classes, activation='softmax')(x)
-                return Model(inputs=base_model.input, outputs=output)
-
-            # Load scan type classifier
-            self.scan_type_model = create_scan_classifier()
-            self.scan_type_model.load_weights('models/ct_vs_xray_classifier.h5')
-
-            # Load CT models
-            # EfficientNetV2S (now the default)
-            eff_base = EfficientNetV2S(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-            self.ct_efficientnetv2s = build_ct_model(eff_base, num_classes=4)
-            self.ct_efficientnetv2s.load_weights('models/ct_efficientnetv2s.h5')
-            self.ct_efficientnetv2s.compile(optimizer=Adam(1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
-
-            # ResNet50
-            resnet_base = ResNet50(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-            self.ct_resnet50 = build_ct_model(resnet_base, num_classes=4)
-            self.ct_resnet50.load_weights('models/ct_resnet50.h5')
-            self.ct_resnet50.compile(optimizer=Adam(1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
-
-            # Define X-ray model builder (binary classification)
-            def build_xray_model(base_model):
-                x = base_model.output
-                x = GlobalAveragePooling2D()(x)
-                x = Dropout(0.3)(x)
-                output = Dense(1, activation='sigmoid')(x)
-                return Model(inputs=base_model.input, outputs=output)
-
-            # Load X-ray models
-            # MobileNetV2
-            mobile_base = MobileNetV2(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-            self.xray_mobilenetv2 = build_xray_model(mobile_base)
-            self.xray_mobilenetv2.load_weights('models/xray_mobilenetv2.h5')
-            self.xray_mobilenetv2.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
-
-            # VGG16
-            vgg_base = VGG16(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-            self.xray_vgg16 = build_xray_model(vgg_base)
-            self.xray_vgg16.load_weights('models/xray_vgg16.h5')
-            self.xray_vgg16.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
+            # Initialize heatmap generator; its fused prediction + Grad-CAM
+            # passes are built per model as the models get loaded
+            heatmap_store = HeatmapStore(
+                os.path.join(BACKEND_DIR, 'static', 'heatmaps', 'generated'),
+                mode=config.HEATMAP_STORE,
+                max_files=config.HEATMAP_MAX_FILES,
+                max_bytes=config.HEATMAP_MAX_MB * 1024 * 1024,
+                max_age_seconds=config.HEATMAP_MAX_AGE_S,
+                sweep_interval_seconds=config.HEATMAP_SWEEP_INTERVAL_S,
+            )
+            heatmap_store.start_sweeper()
+            heatmap_sizes = {'full': config.HEATMAP_MAX_SIZE}
+            if config.HEATMAP_THUMBNAIL_SIZE:
+                heatmap_sizes['thumbnail'] = config.HEATMAP_THUMBNAIL_SIZE
+            renderer = OverlayRenderer(
+                alpha=config.HEATMAP_ALPHA,
+                colormap=config.HEATMAP_COLORMAP,
+                extension=config.HEATMAP_FORMAT,
+                quality=config.HEATMAP_QUALITY,
+                progressive=config.HEATMAP_PROGRESSIVE,
+            )
+            self.heatmap_generator = HeatmapGenerator(heatmap_store, renderer, heatmap_sizes)
+
+            # Models are loaded on first use and evicted least-recently-used
+            # once the pool exceeds its memory budget
+            # Models served by TFLite keep a Keras twin, loaded only for Grad-CAM
+            self.backends = {name: config.INFERENCE_BACKENDS.get(name, 'keras') for name in MODEL_SPECS}
+            keras_models = [name for name, backend in self.backends.items() if backend == 'keras']
+            if config.WORKERS > 1 and keras_models:
+                logger.warning(
+                    "Each of the %d serve.py workers loads its own copy of %s: memory grows with the "
+                    "number of workers.", config.WORKERS, ', '.join(keras_models),
+                )
+            model_names = list(MODEL_SPECS)
+            model_names += [name + KERAS_SUFFIX for name, backend in self.backends.items() if backend != 'keras']
+            model_names += list(ENSEMBLES)
+            self.registry = ModelRegistry(
+                self._load_model,
+                model_names,
+                memory_budget_mb=config.MODEL_MEMORY_BUDGET_MB,
+                on_evict=self._on_evict,
+            )
+            self.registry.warm_up(
+                config.MODEL_WARMUP,
+                prepare=self._warm_up_model if config.WARMUP_INFERENCE else None,
+            )
+
+            # Concurrent requests for the same model share one forward pass
+            self.scheduler = MicroBatchScheduler(
+                self._predict_batch,
+                max_batch_size=config.BATCH_MAX_SIZE,
+                max_wait_ms=config.BATCH_MAX_WAIT_MS,
+            )
             
-            # Initialize heatmap generator
-            self.heatmap_generator = HeatmapGenerator()
+            # Repeat uploads of the same study are answered without TensorFlow
+            self.cache = ResultCache(
+                max_entries=config.RESULT_CACHE_SIZE,
+                ttl_seconds=config.RESULT_CACHE_TTL_S,
+                disk_path=config.RESULT_CACHE_DB or None,
+                max_disk_entries=config.RESULT_CACHE_DISK_SIZE,
+            )
             
-            print("All models loaded successfully")
+            METRICS.register_gauges(self.metric_gauges)
+            METRICS.register_counters(self.metric_counters)
+            logger.info("Model registry initialized")
             
         except Exception as e:
-            print(f"Error loading models: {str(e)}")
+            logger.error("Error loading models: %s", e)
             raise
 
-        self.ct_classes = ['Adenocarcinoma', 'Large Cell Carcinoma', 'Squamous Cell Carcinoma', 'normal']
-        self.xray_classes = ['pneumonia', 'normal']
+        self.ct_classes = CT_CLASSES
+        self.xray_classes = XRAY_CLASSES
+
+    def _load_model(self, name):
+        if name in ENSEMBLES:
+            # The graph only references its members' weights, so it adds
+            # nothing to the budget; the members are pinned for as long as
+            # the graph is resident, since it keeps their weights alive
+            for member in ENSEMBLES[name]:
+                keras_name = member if self.backends[member] == 'keras' else member + KERAS_SUFFIX
+                self.registry.pin(keras_name, holder=name)
+            members = {member: self.keras_model(member) for member in ENSEMBLES[name]}
+            return CompiledModel(
+                build_ensemble(members, config.ENSEMBLE_FUSION, config.ENSEMBLE_WEIGHTS),
+                jit_compile=config.XLA_COMPILE,
+                batch_sizes=config.WARMUP_BATCH_SIZES,
+                size_bytes=0,
+            )
+        if name.endswith(KERAS_SUFFIX):
+            return load_model(name[:-len(KERAS_SUFFIX)])
+        backend = self.backends[name]
+        if backend == 'keras':
+            return CompiledModel(load_model(name), jit_compile=config.XLA_COMPILE,
+                                 batch_sizes=config.WARMUP_BATCH_SIZES)
+        if backend in ('tflite-float16', 'tflite-int8'):
+            return load_tflite_model(
+                name,
+                backend.split('-', 1)[1],
+                num_interpreters=config.TFLITE_INTERPRETERS,
+                num_threads=config.TFLITE_THREADS or None,
+            )
+        raise ValueError(f"Unknown inference backend for {name}: {backend}")
+
+    def _on_evict(self, name):
+        if name.endswith(KERAS_SUFFIX):
+            self.heatmap_generator.remove_model(name[:-len(KERAS_SUFFIX)])
+        elif self.backends.get(name) == 'keras':
+            self.heatmap_generator.remove_model(name)
+            # An ensemble graph would keep the evicted member's weights alive
+            for ensemble_name, members in ENSEMBLES.items():
+                if name in members:
+                    self.registry.evict(ensemble_name)
+
+    def _warm_up_model(self, name, model):
+        """Trace the serving graphs of a freshly loaded model, and its Grad-CAM pass, with blank images."""
+        start = time.perf_counter()
+        if hasattr(model, 'warm_up'):
+            model.warm_up()
+        # TFLite models get Grad-CAM from their Keras twin, warmed up on its own
+        if name.endswith(KERAS_SUFFIX):
+            model_name, keras_model = name[:-len(KERAS_SUFFIX)], model
+        else:
+            model_name, keras_model = name, getattr(model, 'keras_model', None)
+        if model_name in self.heatmap_generator.model_layers and keras_model is not None:
+            blank = np.zeros((1,) + INPUT_SHAPE, np.uint8)
+            self.heatmap_generator.predict_with_heatmap(model_name, blank, keras_model)
+        logger.info("Warmed up %s in %.2fs", name, time.perf_counter() - start)
+
+    def keras_model(self, model_name):
+        """The Keras model of ``model_name``, needed for gradients whatever the serving backend."""
+        if self.backends[model_name] == 'keras':
+            return self.registry.get(model_name).keras_model
+        return self.registry.get(model_name + KERAS_SUFFIX)
+
+    def _predict_batch(self, model_name, batch):
+        with METRICS.time('lung_model_batch_seconds', model=model_name):
+            if model_name.endswith(GRADCAM_SUFFIX):
+                model_name = model_name[:-len(GRADCAM_SUFFIX)]
+                model = self.keras_model(model_name)
+                return self.heatmap_generator.predict_with_heatmap(model_name, batch, model)
+            if model_name in ENSEMBLES:
+                # Using the graph counts as using its members, so the pool
+                # does not evict them from under it
+                for member in ENSEMBLES[model_name]:
+                    self.registry.get(member)
+            return self.registry.get(model_name).predict_on_batch(batch)
+
+    def metric_gauges(self):
+        """Current cache size, queue, heatmap store and model pool state for /metrics."""
+        for model_name, queue in self.scheduler.stats()['models'].items():
+            yield 'lung_scheduler_queue_depth', {'model': model_name}, queue['queue_depth']
+            yield 'lung_scheduler_mean_batch_size', {'model': model_name}, queue['mean_batch_size']
+        yield 'lung_result_cache_entries', {'tier': 'memory'}, self.cache.stats()['memory_entries']
+        store = self.heatmap_generator.store.stats()
+        yield 'lung_heatmap_store_entries', {'mode': store['mode']}, store['entries']
+        yield 'lung_heatmap_store_bytes', {'mode': store['mode']}, store['bytes']
+        registry = self.registry.status()
+        for model_name, model in registry['models'].items():
+            yield 'lung_model_loaded', {'model': model_name}, int(model['loaded'])
+        yield 'lung_model_resident_bytes', {}, registry['resident_mb'] * 1024 * 1024
+
+    def metric_counters(self):
+        """Result cache events since startup for /metrics."""
+        cache = self.cache.stats()
+        for event in ('memory_hits', 'disk_hits', 'misses', 'stores', 'evictions', 'expirations'):
+            yield 'lung_result_cache_events_total', {'event': event}, cache[event]
+
+    def predict(self, model_name, img_array):
+        """Run ``model_name`` on ``img_array`` through the micro-batching scheduler."""
+        return self.scheduler.predict(model_name, img_array)
+
+    def predict_with_heatmap(self, model_name, img_array):
+        """Class scores and Grad-CAM heatmaps of ``model_name`` from one fused pass."""
+        return self.scheduler.predict(model_name + GRADCAM_SUFFIX, img_array)
+
+    def predict_images(self, model_name, images, with_heatmap=False):
+        """Outputs of ``model_name`` for a list of ``(1, H, W, 3)`` uint8 images, in their order.
+
+        The images go through the scheduler as one batch; any not yet at the
+        models' input size (see :attr:`ScanImage.pixels`) are resized first
+        so that they stack. With ``with_heatmap`` returns ``(scores,
+        heatmaps)`` like :meth:`predict_with_heatmap`, and for an ensemble
+        graph a tuple of its outputs.
+        """
+        queue_name = model_name + GRADCAM_SUFFIX if with_heatmap else model_name
+        batch = np.concatenate([
+            image if image.shape[1:] == INPUT_SHAPE else fit_input_size(image) for image in images
+        ])
+        return self.scheduler.predict(queue_name, batch)
 
     def preprocess_image(self, img_path):
         try:
-            img = image.load_img(img_path, target_size=(224, 224))
-            img_array = image.img_to_array(img) / 255.0
-            img_array = np.expand_dims(img_array, axis=0)
-            print(f"Image shape after preprocessing: {img_array.shape}")
-            return img_array
+            return ScanImage.from_path(img_path).pixels
         except Exception as e:
-            print(f"Error in preprocessing: {str(e)}")
+            logger.error("Error in preprocessing: %s", e)
             raise
 
     def detect_scan_type(self, img_array):
         try:
-            scan_pred = self.scan_type_model.predict(img_array, verbose=0)[0][0]
-            print(f"Scan type prediction: {scan_pred}")
+            with METRICS.time('lung_stage_seconds', stage='scan_detection'):
+                scan_pred = self.predict('scan_classifier', img_array)[0][0]
+            logger.debug("Scan type prediction: %s", scan_pred)
             return "ct" if scan_pred < 0.5 else "xray"
         except Exception as e:
-            print(f"Error in scan type detection: {str(e)}")
+            logger.error("Error in scan type detection: %s", e)
             return "unknown"
 
-    def get_model_predictions(self, img_array, scan_type):
+    def plan_models(self, scan_type, model_type='default'):
+        """Return the disease models that have to run for this request.
+
+        A pinned ``model_type`` runs only that model, ``ensemble`` runs both
+        models of the scan type, ``cascade`` starts with the first cascade
+        model (see :meth:`cascade_escalation`) and auto/default runs the
+        models the auto selection needs (EfficientNetV2S for CT, both X-ray
+        models).
+        """
+        model_type = MODEL_ALIASES.get(model_type, model_type)
+        scan_models = SCAN_MODELS[scan_type]
+        if model_type in scan_models:
+            return [model_type]
+        if model_type == 'ensemble':
+            return list(scan_models)
+        if self.is_cascade(model_type):
+            return [CASCADES[scan_type][0]]
+        if scan_type == 'ct':
+            return ['ct_efficientnetv2s']
+        return list(scan_models)
+
+    def ensemble_graph(self, model_names):
+        """Registry name of the ensemble graph running exactly ``model_names``, or None.
+
+        None also when the graph is disabled or a member is served by TFLite,
+        in which case the models run one after the other.
+        """
+        if not config.ENSEMBLE_GRAPH:
+            return None
+        for ensemble_name, members in ENSEMBLES.items():
+            if list(model_names) == list(members) and all(self.backends[m] == 'keras' for m in members):
+                return ensemble_name
+        return None
+
+    def is_cascade(self, model_type):
+        model_type = MODEL_ALIASES.get(model_type, model_type)
+        if model_type == 'cascade':
+            return True
+        pinned = model_type == 'ensemble' or any(model_type in models for models in SCAN_MODELS.values())
+        return config.AUTO_MODE == 'cascade' and not pinned
+
+    def cascade_escalation(self, scan_type, model_type, predictions):
+        """The cascade's second model when its first one is not confident enough, else None."""
+        if not self.is_cascade(model_type):
+            return None
+        first, second = CASCADES[scan_type]
+        escalate = predictions[PREDICTION_KEYS[first]]['confidence'] < config.CASCADE_THRESHOLDS[scan_type]
+        METRICS.inc('lung_cascade_total', scan_type=scan_type, outcome='escalated' if escalate else 'accepted')
+        return second if escalate else None
+
+    def _decode_prediction(self, model_name, output):
+        if model_name.startswith('ct_'):
+            class_idx = int(np.argmax(output))
+            return {
+                'disease': self.ct_classes[class_idx],
+                'confidence': float(output[class_idx])
+            }
+        # X-ray models are binary classifiers
+        score = output[0]
+        disease = 'pneumonia' if score > 0.5 else 'normal'
+        return {
+            'disease': disease,
+            'confidence': float(score if disease == 'pneumonia' else 1 - score)
+        }
+
+    @staticmethod
+    def _decode_probabilities(scan_type, probabilities):
+        classes = CT_CLASSES if scan_type == 'ct' else XRAY_CLASSES
+        class_idx = int(np.argmax(probabilities))
+        return {'disease': classes[class_idx], 'confidence': float(probabilities[class_idx])}
+
+    def get_model_predictions(self, img_array, scan_type, model_names=None):
+        """Run ``model_names`` (default: the auto plan) and return their predictions.
+
+        Returns ``(predictions, timings)`` where ``predictions`` is keyed by the
+        short model key used in the API response and ``timings`` holds the
+        wall time of each model in milliseconds. When both models of the scan
+        type run as one ensemble graph, ``timings`` holds the graph's time and
+        ``predictions`` also has the fused diagnosis under ``ensemble``.
+        """
+        if model_names is None:
+            model_names = self.plan_models(scan_type)
         predictions = {}
+        timings = {}
         try:
-            if scan_type == "ct":
-                # Get predictions from both CT models
-                effnet_pred = self.ct_efficientnetv2s.predict(img_array, verbose=0)[0]
-                resnet_pred = self.ct_resnet50.predict(img_array, verbose=0)[0]
-                
-                effnet_class_idx = np.argmax(effnet_pred)
-                resnet_class_idx = np.argmax(resnet_pred)
-                
-                predictions['efficientnet'] = {
-                    'disease': self.ct_classes[effnet_class_idx],
-                    'confidence': float(effnet_pred[effnet_class_idx])
-                }
-                predictions['resnet50'] = {
-                    'disease': self.ct_classes[resnet_class_idx],
-                    'confidence': float(resnet_pred[resnet_class_idx])
-                }
-            else:
-                # Get predictions from both X-ray models (binary classification)
-                mobilenet_pred = self.xray_mobilenetv2.predict(img_array, verbose=0)[0][0]
-                vgg_pred = self.xray_vgg16.predict(img_array, verbose=0)[0][0]
-                
-                # Convert binary predictions to class labels
-                mobilenet_class = 'pneumonia' if mobilenet_pred > 0.5 else 'normal'
-                vgg_class = 'pneumonia' if vgg_pred > 0.5 else 'normal'
-                
-                predictions['mobilenet'] = {
-                    'disease': mobilenet_class,
-                    'confidence': float(mobilenet_pred if mobilenet_class == 'pneumonia' else 1 - mobilenet_pred)
-                }
-                predictions['vgg16'] = {
-                    'disease': vgg_class,
-                    'confidence': float(vgg_pred if vgg_class == 'pneumonia' else 1 - vgg_pred)
-                }
-            
-            return predictions
+            ensemble_name = self.ensemble_graph(model_names)
+            if ensemble_name is not None:
+                start = time.perf_counter()
+                *heads, fused = self.predict(ensemble_name, img_array)
+                elapsed = time.perf_counter() - start
+                METRICS.observe('lung_model_seconds', elapsed, model=ensemble_name)
+                timings[ensemble_name] = elapsed * 1000.0
+                for model_name, head in zip(model_names, heads):
+                    predictions[PREDICTION_KEYS[model_name]] = self._decode_prediction(model_name, head[0])
+                predictions[ENSEMBLE_KEY] = self._decode_probabilities(scan_type, fused[0])
+                return predictions, timings
+            for model_name in model_names:
+                start = time.perf_counter()
+                output = self.predict(model_name, img_array)[0]
+                elapsed = time.perf_counter() - start
+                METRICS.observe('lung_model_seconds', elapsed, model=model_name)
+                timings[model_name] = elapsed * 1000.0
+                predictions[PREDICTION_KEYS[model_name]] = self._decode_prediction(model_name, output)
+            return predictions, timings
+        except Exception as e:
+            logger.error("Error getting model predictions: %s", e)
+            return None, timings
+
+    def get_fused_prediction(self, img_array, model_name):
+        """Like :meth:`get_model_predictions` for one model, also returning its Grad-CAM heatmap.
+
+        Falls back to a plain prediction (and no heatmap) if the fused pass fails.
+        """
+        try:
+            start = time.perf_counter()
+            output, heatmaps = self.predict_with_heatmap(model_name, img_array)
+            elapsed = time.perf_counter() - start
+            METRICS.observe('lung_model_seconds', elapsed, model=model_name + GRADCAM_SUFFIX)
+            timings = {model_name: elapsed * 1000.0}
+            predictions = {PREDICTION_KEYS[model_name]: self._decode_prediction(model_name, output[0])}
+            return predictions, timings, heatmaps[0]
         except Exception as e:
-            print(f"Error getting model predictions: {str(e)}")
+            logger.error("Error in fused prediction for %s: %s", model_name, e)
+            predictions, timings = self.get_model_predictions(img_array, model_name.split('_')[0], [model_name])
+            return predictions, timings, None
+
+    def uses_fused_pass(self, models_run):
+        """Whether the plan's prediction and Grad-CAM can come from one fused pass."""
+        return (len(models_run) == 1 and models_run[0] in self.heatmap_generator.model_layers
+                and self.backends[models_run[0]] == 'keras')
+
+    @staticmethod
+    def _visualization_fields(heatmaps):
+        """``visualization`` (the full-size overlay) and every size variant of a result."""
+        heatmaps = heatmaps or {}
+        return {"visualization": heatmaps.get('full'), "visualizations": heatmaps}
+
+    def _cache_key(self, scan_image, model_type):
+        if not self.cache.enabled:
             return None
+        return ResultCache.make_key(scan_image.content_hash, MODEL_ALIASES.get(model_type, model_type))
 
-    def process_image(self, img_path, model_type='default'):
+    def _lookup_cache(self, scan_image, model_type):
+        """Return ``(cache_key, cached_result)``; both are None when caching is off."""
+        cache_key = self._cache_key(scan_image, model_type)
+        if cache_key is None:
+            return None, None
+        cached = self.cache.get(cache_key)
+        # A cached result is only usable while its heatmap can still be served
+        if cached is not None and self.heatmap_generator.store.contains(cached['visualization']):
+            cached['cached'] = True
+            return cache_key, cached
+        return cache_key, None
+
+    def process_image(self, scan_image, model_type='default', with_heatmap=True, single_model=False):
+        """Classify ``scan_image`` (a ScanImage, or a path to an image file).
+
+        With ``with_heatmap=False`` the result is returned without running
+        Grad-CAM (``visualization`` is None); :meth:`render_heatmap` adds it later.
+        With ``single_model=True`` (load shedding) only the first model of the
+        plan runs and the result lists ``"ensemble"`` under ``degraded``.
+        """
         try:
-            print(f"\nProcessing image: {img_path}")
-            img_array = self.preprocess_image(img_path)
+            if not isinstance(scan_image, ScanImage):
+                logger.debug("Processing image: %s", scan_image)
+                scan_image = ScanImage.from_path(scan_image)
+
+            with METRICS.time('lung_stage_seconds', stage='cache_lookup'):
+                cache_key, cached = self._lookup_cache(scan_image, model_type)
+            if cached is not None:
+                return cached
+
+            img_array = scan_image.pixels
             scan_type = self.detect_scan_type(img_array)
-            print(f"Detected scan type: {scan_type}")
+            METRICS.inc('lung_scan_type_total', scan_type=scan_type)
+            logger.debug("Detected scan type: %s", scan_type)
             
             if scan_type == "unknown":
                 return {
@@ -158,11 +454,25 @@ class ImageProcessor:
                     "confidence": 0.0,
                     "model_used": "error",
                     "all_predictions": {},
+                    "models_run": [],
+                    "model_timings": {},
                     "visualization": None
                 }
             
-            # Get predictions from all relevant models
-            predictions = self.get_model_predictions(img_array, scan_type)
+            # Run only the models this request needs
+            models_run = self.plan_models(scan_type, model_type)
+            degraded = []
+            if single_model and len(models_run) > 1:
+                models_run = models_run[:1]
+                degraded.append('ensemble')
+            cam = None
+            with METRICS.time('lung_stage_seconds', stage='classification'):
+                if with_heatmap and self.uses_fused_pass(models_run):
+                    # The visualised model is known up front: score it and build its
+                    # Grad-CAM in one pass instead of a predict plus a second forward pass
+                    predictions, timings, cam = self.get_fused_prediction(img_array, models_run[0])
+                else:
+                    predictions, timings = self.get_model_predictions(img_array, scan_type, models_run)
             
             if not predictions:
                 return {
@@ -171,58 +481,395 @@ class ImageProcessor:
                     "confidence": 0.0,
                     "model_used": "error",
                     "all_predictions": {},
+                    "models_run": models_run,
+                    "model_timings": timings,
                     "visualization": None
                 }
             
-            # For CT scans and X-rays, use the user-selected model if specified, otherwise use auto-detection
-            if scan_type == "ct":
-                if model_type in ["ct_efficientnetb0", "ct_efficientnetv2s"]:
-                    best_prediction = predictions['efficientnet']
-                    model_used = 'ct_efficientnetv2s'
-                    model = self.ct_efficientnetv2s
-                elif model_type == "ct_resnet50":
-                    best_prediction = predictions['resnet50']
-                    model_used = 'ct_resnet50'
-                    model = self.ct_resnet50
-                else:  # auto/default
-                    best_prediction = predictions['efficientnet']
-                    model_used = 'ct_efficientnetv2s'
-                    model = self.ct_efficientnetv2s
-            else:  # xray
-                if model_type == "xray_vgg16":
-                    best_prediction = predictions['vgg16']
-                    model_used = 'xray_vgg16'
-                    model = self.xray_vgg16
-                elif model_type == "xray_mobilenetv2":
-                    best_prediction = predictions['mobilenet']
-                    model_used = 'xray_mobilenetv2'
-                    model = self.xray_mobilenetv2
-                else:  # auto/default
-                    # Use the model with the highest confidence
-                    best_prediction = max(predictions.values(), key=lambda x: x['confidence'])
-                    model_used = 'xray_mobilenetv2' if best_prediction == predictions['mobilenet'] else 'xray_vgg16'
-                    model = self.xray_mobilenetv2 if model_used == 'xray_mobilenetv2' else self.xray_vgg16
+            escalation = self.cascade_escalation(scan_type, model_type, predictions)
+            if escalation is not None and single_model:
+                degraded.append('ensemble')
+            elif escalation is not None:
+                extra_predictions, extra_timings = self.get_model_predictions(img_array, scan_type, [escalation])
+                timings.update(extra_timings)
+                if extra_predictions:
+                    predictions.update(extra_predictions)
+                    models_run = models_run + [escalation]
             
-            print(f"\nGenerating heatmap for model: {model_used}")
-            # Generate heatmap visualization
-            heatmap = self.heatmap_generator.generate_visualization(model, img_path, model_used)
-            print(f"Generated heatmap: {heatmap}")
+            # A single planned model is the answer; with several, the most confident
+            # one wins, unless an ensemble graph fused them (model_used is then
+            # the most confident member, whose heatmap is shown)
+            model_used = max(models_run, key=lambda name: predictions[PREDICTION_KEYS[name]]['confidence'])
+            best_prediction = predictions.get(ENSEMBLE_KEY, predictions[PREDICTION_KEYS[model_used]])
+            if model_used != models_run[0]:
+                # The fused pass only produced the first model's heatmap
+                cam = None
             
-            return {
+            METRICS.inc('lung_model_selected_total', model=model_used)
+            heatmaps = None
+            if with_heatmap:
+                with METRICS.time('lung_stage_seconds', stage='visualization'):
+                    heatmaps = self.heatmap_generator.generate_visualization(
+                        self.keras_model(model_used), scan_image, model_used, heatmap=cam
+                    )
+                logger.debug("Generated heatmaps: %s", heatmaps)
+            
+            result = {
                 "scan_type": scan_type,
                 "disease": best_prediction['disease'],
                 "confidence": best_prediction['confidence'],
                 "model_used": model_used,
                 "all_predictions": predictions,
-                "visualization": heatmap
+                "models_run": models_run,
+                "model_timings": timings,
+                **self._visualization_fields(heatmaps),
+                "cached": False,
+                "degraded": degraded
             }
+            # A degraded result is not what the next request for this scan should get
+            if cache_key is not None and result['visualization'] is not None and not degraded:
+                self.cache.put(cache_key, result)
+            return result
         except Exception as e:
-            print(f"Error processing image: {str(e)}")
+            logger.exception("Error processing image: %s", e)
             return {
                 "scan_type": "unknown",
                 "disease": "unknown",
                 "confidence": 0.0,
                 "model_used": "error",
                 "all_predictions": {},
+                "models_run": [],
+                "model_timings": {},
                 "visualization": None
             }
+
+    def render_heatmap(self, scan_image, result, model_type='default'):
+        """Grad-CAM overlay for a result of ``process_image(..., with_heatmap=False)``.
+
+        Returns the result's visualization fields (None when no heatmap could
+        be rendered) and caches the completed result.
+        """
+        model_used = result['model_used']
+        if model_used not in self.heatmap_generator.model_layers:
+            return None
+        # Through the scheduler, so concurrent jobs for the same model share a pass
+        _, cams = self.predict_with_heatmap(model_used, scan_image.pixels)
+        with METRICS.time('lung_stage_seconds', stage='visualization'):
+            heatmaps = self.heatmap_generator.generate_visualization(
+                self.keras_model(model_used), scan_image, model_used, heatmap=cams[0]
+            )
+        if not heatmaps:
+            return None
+        fields = self._visualization_fields(heatmaps)
+        cache_key = self._cache_key(scan_image, model_type)
+        if cache_key is not None and not result.get('degraded'):
+            self.cache.put(cache_key, dict(result, cached=False, **fields))
+        return fields
+
+    def _class_probabilities(self, model_name, outputs):
+        """``(N, classes)`` probabilities of CT_CLASSES or XRAY_CLASSES for a batch of model outputs."""
+        outputs = np.asarray(outputs, dtype=np.float32)
+        if model_name.startswith('ct_'):
+            return outputs
+        # X-ray models output P(pneumonia)
+        return np.concatenate([outputs[:, :1], 1 - outputs[:, :1]], axis=1)
+
+    def process_study(self, series, model_type='default', top_k=5, batch_size=16, with_heatmaps=True,
+                      single_model=False):
+        """Classify every slice of a DicomSeries and aggregate them into one study result.
+
+        Slices are decoded and classified ``batch_size`` at a time, so memory
+        is bounded by one batch plus the ``top_k`` most suspicious slices
+        (highest probability of any abnormal class), which are returned with
+        Grad-CAM heatmaps. The study is abnormal when any slice is; its
+        diagnosis is then the abnormal class with the highest slice probability.
+        ``single_model`` is as for :meth:`process_image`.
+        """
+        scan_type = series.scan_type
+        models_run = None
+        classes = None
+        class_sums = None
+        class_counts = None
+        strongest = None  # (class index, probability) of the most confident abnormal slice
+        suspicious = []  # min-heap of (suspicion, slice_index, instance_number, probabilities, ScanImage)
+        timings = {}
+        escalated = 0
+        slice_count = 0
+        degraded = []
+
+        for batch_items in series.batches(batch_size):
+            batch = [scan_image.pixels for _, _, scan_image in batch_items]
+            if scan_type is None:
+                # No usable Modality tag: the scan classifier votes on the first batch
+                with METRICS.time('lung_stage_seconds', stage='scan_detection'):
+                    scores = self.predict_images('scan_classifier', batch)[:, 0]
+                scan_type = 'ct' if np.mean(scores < 0.5) >= 0.5 else 'xray'
+            if models_run is None:
+                METRICS.inc('lung_scan_type_total', scan_type=scan_type)
+                models_run = self.plan_models(scan_type, model_type)
+                if single_model and (len(models_run) > 1 or self.is_cascade(model_type)):
+                    models_run = models_run[:1]
+                    degraded.append('ensemble')
+                classes = CT_CLASSES if scan_type == 'ct' else XRAY_CLASSES
+                class_sums = np.zeros(len(classes))
+                class_counts = np.zeros(len(classes), dtype=int)
+
+            with METRICS.time('lung_stage_seconds', stage='classification'):
+                ensemble_name = self.ensemble_graph(models_run)
+                outputs = {}
+                for model_name in [ensemble_name] if ensemble_name is not None else models_run:
+                    start = time.perf_counter()
+                    outputs[model_name] = self.predict_images(model_name, batch)
+                    elapsed = time.perf_counter() - start
+                    METRICS.observe('lung_model_seconds', elapsed, model=model_name)
+                    timings[model_name] = timings.get(model_name, 0.0) + elapsed * 1000.0
+                if ensemble_name is not None:
+                    # Slices average the members' probabilities whatever the fusion
+                    outputs = dict(zip(models_run, outputs.pop(ensemble_name)))
+                probabilities = sum(self._class_probabilities(name, outputs[name]) for name in models_run)
+                probabilities /= len(models_run)
+
+                if self.is_cascade(model_type) and not single_model:
+                    second = CASCADES[scan_type][1]
+                    unsure = np.flatnonzero(probabilities.max(axis=1) < config.CASCADE_THRESHOLDS[scan_type])
+                    METRICS.inc('lung_cascade_total', len(batch_items) - len(unsure), scan_type=scan_type, outcome='accepted')
+                    if len(unsure):
+                        METRICS.inc('lung_cascade_total', len(unsure), scan_type=scan_type, outcome='escalated')
+                        start = time.perf_counter()
+                        second_probabilities = self._class_probabilities(
+                            second, self.predict_images(second, [batch[i] for i in unsure])
+                        )
+                        timings[second] = timings.get(second, 0.0) + (time.perf_counter() - start) * 1000.0
+                        probabilities[unsure] = (probabilities[unsure] + second_probabilities) / 2
+                        escalated += len(unsure)
+
+            normal = classes.index('normal')
+            for (index, instance_number, scan_image), slice_probabilities in zip(batch_items, probabilities):
+                class_sums += slice_probabilities
+                class_idx = int(np.argmax(slice_probabilities))
+                class_counts[class_idx] += 1
+                if class_idx != normal and (strongest is None or slice_probabilities[class_idx] > strongest[1]):
+                    strongest = (class_idx, float(slice_probabilities[class_idx]))
+                entry = (1.0 - float(slice_probabilities[normal]), index, instance_number, slice_probabilities, scan_image)
+                if len(suspicious) < top_k:
+                    heapq.heappush(suspicious, entry)
+                elif top_k > 0 and entry[0] > suspicious[0][0]:
+                    heapq.heapreplace(suspicious, entry)
+            slice_count += len(batch_items)
+
+        if not slice_count:
+            raise ValueError("The study has no slices")
+
+        normal = classes.index('normal')
+        top = sorted(suspicious, key=lambda entry: entry[0], reverse=True)
+        abnormal_slices = slice_count - int(class_counts[normal])
+        if strongest is not None:
+            # The study is as abnormal as its most abnormal slice
+            disease, confidence = classes[strongest[0]], strongest[1]
+        else:
+            disease, confidence = 'normal', float(class_sums[normal] / slice_count)
+
+        model_used = models_run[0]
+        heatmaps = [None] * len(top)
+        if with_heatmaps and top and model_used in self.heatmap_generator.model_layers:
+            try:
+                _, cams = self.predict_images(model_used, [entry[4].pixels for entry in top], with_heatmap=True)
+                model = self.keras_model(model_used)
+                with METRICS.time('lung_stage_seconds', stage='visualization'):
+                    heatmaps = [
+                        self.heatmap_generator.generate_visualization(model, entry[4], model_used, heatmap=cam)
+                        for entry, cam in zip(top, cams)
+                    ]
+            except Exception as e:
+                logger.error("Error in study Grad-CAM for %s: %s", model_used, e)
+
+        if escalated:
+            # As for a single image, the cascade's second model ran too
+            models_run = models_run + [CASCADES[scan_type][1]]
+        METRICS.inc('lung_model_selected_total', model=model_used)
+        return {
+            "scan_type": scan_type,
+            "modality": series.modality,
+            "disease": disease,
+            "confidence": confidence,
+            "model_used": model_used,
+            "models_run": models_run,
+            "model_timings": timings,
+            "slice_count": slice_count,
+            "abnormal_slices": abnormal_slices,
+            "escalated_slices": escalated,
+            "degraded": degraded,
+            "class_slice_counts": {name: int(count) for name, count in zip(classes, class_counts)},
+            "mean_probabilities": {name: float(total / slice_count) for name, total in zip(classes, class_sums)},
+            "top_slices": [
+                {
+                    "slice_index": index,
+                    "instance_number": instance_number,
+                    "disease": classes[int(np.argmax(slice_probabilities))],
+                    "confidence": float(np.max(slice_probabilities)),
+                    "suspicion": suspicion,
+                    "probabilities": {name: float(p) for name, p in zip(classes, slice_probabilities)},
+                    **self._visualization_fields(slice_heatmaps),
+                }
+                for (suspicion, index, instance_number, slice_probabilities, _), slice_heatmaps in zip(top, heatmaps)
+            ],
+        }
+
+    def process_batch(self, images, model_type='default', with_heatmaps=True, chunk_size=32, single_model=False):
+        """Classify many images, yielding ``(name, result)`` as each chunk finishes.
+
+        ``images`` is an iterable of ``(name, image_bytes)``; it is consumed
+        and decoded one chunk at a time. Within a chunk the scan classifier
+        runs once over all images, then every disease model runs once per
+        scan-type group and Grad-CAM once per winning model. ``single_model``
+        is as for :meth:`process_image`.
+        """
+        chunk = []
+        for name, data in images:
+            chunk.append((name, data))
+            if len(chunk) >= chunk_size:
+                yield from self._process_chunk(chunk, model_type, with_heatmaps, single_model)
+                chunk = []
+        if chunk:
+            yield from self._process_chunk(chunk, model_type, with_heatmaps, single_model)
+
+    def _process_chunk(self, chunk, model_type, with_heatmaps, single_model):
+        pending = []
+        for name, data in chunk:
+            try:
+                scan_image = decode_image(data)
+            except ValueError as e:
+                yield name, {"error": str(e)}
+                continue
+            cache_key, cached = self._lookup_cache(scan_image, model_type)
+            if cached is not None:
+                yield name, cached
+            else:
+                pending.append((name, scan_image, cache_key))
+        if not pending:
+            return
+
+        try:
+            scan_scores = self.predict_images('scan_classifier', [item[1].pixels for item in pending])[:, 0]
+        except Exception as e:
+            logger.error("Error in batched scan type detection: %s", e)
+            for name, _, _ in pending:
+                yield name, {"error": f"Scan type detection failed: {str(e)}"}
+            return
+
+        groups = {'ct': [], 'xray': []}
+        for item, score in zip(pending, scan_scores):
+            groups["ct" if score < 0.5 else "xray"].append(item)
+        for scan_type, items in groups.items():
+            if items:
+                METRICS.inc('lung_scan_type_total', len(items), scan_type=scan_type)
+
+        for scan_type, items in groups.items():
+            if items:
+                yield from self._process_group(scan_type, items, model_type, with_heatmaps, single_model)
+
+    def _process_group(self, scan_type, items, model_type, with_heatmaps, single_model):
+        models_run = self.plan_models(scan_type, model_type)
+        degraded = [[] for _ in items]
+        if single_model and len(models_run) > 1:
+            models_run = models_run[:1]
+            degraded = [['ensemble'] for _ in items]
+        batch = [scan_image.pixels for _, scan_image, _ in items]
+        outputs = {}
+        cams = {}
+        timings = {}
+        ensemble_probabilities = None
+        try:
+            fused = with_heatmaps and self.uses_fused_pass(models_run)
+            ensemble_name = self.ensemble_graph(models_run)
+            if ensemble_name is not None:
+                start = time.perf_counter()
+                *heads, ensemble_probabilities = self.predict_images(ensemble_name, batch)
+                timings[ensemble_name] = (time.perf_counter() - start) * 1000.0
+                outputs = dict(zip(models_run, heads))
+            for model_name in models_run if ensemble_name is None else []:
+                start = time.perf_counter()
+                if fused:
+                    outputs[model_name], cams[model_name] = self.predict_images(model_name, batch, with_heatmap=True)
+                else:
+                    outputs[model_name] = self.predict_images(model_name, batch)
+                timings[model_name] = (time.perf_counter() - start) * 1000.0
+        except Exception as e:
+            logger.error("Error in batched predictions for %s: %s", scan_type, e)
+            for name, _, _ in items:
+                yield name, {"error": f"Prediction failed: {str(e)}", "scan_type": scan_type}
+            return
+
+        all_predictions = [
+            {
+                PREDICTION_KEYS[model_name]: self._decode_prediction(model_name, outputs[model_name][i])
+                for model_name in models_run
+            }
+            for i in range(len(items))
+        ]
+        if ensemble_probabilities is not None:
+            for predictions, probabilities in zip(all_predictions, ensemble_probabilities):
+                predictions[ENSEMBLE_KEY] = self._decode_probabilities(scan_type, probabilities)
+        item_models = [list(models_run) for _ in items]
+        # Cascade: the second model runs once over the images the first was unsure of
+        escalations = [
+            i for i, predictions in enumerate(all_predictions)
+            if self.cascade_escalation(scan_type, model_type, predictions) is not None
+        ]
+        if escalations and single_model:
+            for i in escalations:
+                degraded[i] = ['ensemble']
+        elif escalations:
+            second = CASCADES[scan_type][1]
+            try:
+                start = time.perf_counter()
+                second_outputs = self.predict_images(second, [batch[i] for i in escalations])
+                timings = dict(timings, **{second: (time.perf_counter() - start) * 1000.0})
+                for i, output in zip(escalations, second_outputs):
+                    all_predictions[i][PREDICTION_KEYS[second]] = self._decode_prediction(second, output)
+                    item_models[i].append(second)
+            except Exception as e:
+                logger.error("Error in cascade predictions for %s: %s", scan_type, e)
+
+        results = []
+        for predictions, item_models_run, item_degraded in zip(all_predictions, item_models, degraded):
+            model_used = max(item_models_run, key=lambda model_name: predictions[PREDICTION_KEYS[model_name]]['confidence'])
+            best_prediction = predictions.get(ENSEMBLE_KEY, predictions[PREDICTION_KEYS[model_used]])
+            results.append({
+                "scan_type": scan_type,
+                "disease": best_prediction['disease'],
+                "confidence": best_prediction['confidence'],
+                "model_used": model_used,
+                "all_predictions": predictions,
+                "models_run": item_models_run,
+                "model_timings": timings,
+                "visualization": None,
+                "cached": False,
+                "degraded": item_degraded
+            })
+
+        if with_heatmaps:
+            # Grad-CAM once per winning model for the images it won
+            for model_used in set(result['model_used'] for result in results):
+                indices = [i for i, result in enumerate(results) if result['model_used'] == model_used]
+                try:
+                    if model_used in cams:
+                        model_cams = {i: cams[model_used][i] for i in indices}
+                    else:
+                        model_cams = dict(zip(
+                            indices, self.predict_images(model_used, [batch[i] for i in indices], with_heatmap=True)[1]
+                        ))
+                except Exception as e:
+                    logger.error("Error in batched Grad-CAM for %s: %s", model_used, e)
+                    continue
+                model = self.keras_model(model_used)
+                for i in indices:
+                    results[i].update(self._visualization_fields(self.heatmap_generator.generate_visualization(
+                        model, items[i][1], model_used, heatmap=model_cams[i]
+                    )))
+
+        for (name, _, cache_key), result in zip(items, results):
+            METRICS.inc('lung_model_selected_total', model=result['model_used'])
+            if cache_key is not None and result['visualization'] is not None and not result['degraded']:
+                self.cache.put(cache_key, result)
+            yield name, result
@@ -0,0 +1,123 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobsFull(Exception):
+    """Every job slot holds a heatmap that is still being rendered."""
+
+
+class _Job:
+    def __init__(self, result):
+        self.id = uuid.uuid4().hex
+        self.result = result
+        self.heatmap_status = 'pending'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+
+class JobManager:
+    """Jobs whose classification is known and whose heatmap renders in the background.
+
+    ``submit`` stores a classification result and runs ``render()`` on a pool
+    of ``workers`` threads; it returns the fields to add to the result, or
+    None if no heatmap could be made (without ``render`` the job is complete
+    as submitted).
+    At most ``max_jobs`` jobs are kept and finished ones expire
+    ``ttl_seconds`` after completion. Clients poll :meth:`get` or block in
+    :meth:`wait` until the heatmap is done.
+    """
+
+    def __init__(self, max_jobs=1000, ttl_seconds=600, workers=2):
+        self.max_jobs = max_jobs
+        self.ttl = ttl_seconds
+        self._jobs = OrderedDict()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='heatmap-job')
+        self.counters = {'submitted': 0, 'done': 0, 'errors': 0, 'expired': 0}
+
+    def submit(self, result, render=None):
+        with self._condition:
+            self._expire(time.time())
+            if len(self._jobs) >= self.max_jobs:
+                self._drop_oldest_finished()
+            if len(self._jobs) >= self.max_jobs:
+                raise JobsFull(f"{self.max_jobs} heatmaps are already pending")
+            job = _Job(result)
+            self._jobs[job.id] = job
+            self.counters['submitted'] += 1
+            if render is None:
+                job.heatmap_status = 'done'
+                job.finished = job.created
+                return self.snapshot(job)
+        self._executor.submit(self._run, job, render)
+        return self.snapshot(job)
+
+    def _run(self, job, render):
+        try:
+            fields = render()
+            error = None if fields is not None else 'Heatmap could not be generated'
+        except Exception as e:
+            fields, error = None, str(e)
+        with self._condition:
+            job.result = dict(job.result, **(fields or {}))
+            job.heatmap_status = 'error' if error else 'done'
+            job.error = error
+            job.finished = time.time()
+            self.counters['errors' if error else 'done'] += 1
+            self._condition.notify_all()
+
+    def _expire(self, now):
+        if self.ttl <= 0:
+            return
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.ttl:
+                del self._jobs[job_id]
+                self.counters['expired'] += 1
+
+    def _drop_oldest_finished(self):
+        for job_id, job in self._jobs.items():
+            if job.finished is not None:
+                del self._jobs[job_id]
+                self.counters['expired'] += 1
+                return
+
+    @staticmethod
+    def snapshot(job):
+        return {
+            'job_id': job.id,
+            'heatmap_status': job.heatmap_status,
+            'heatmap_error': job.error,
+            'result': job.result,
+        }
+
+    def get(self, job_id):
+        with self._condition:
+            self._expire(time.time())
+            job = self._jobs.get(job_id)
+            return self.snapshot(job) if job is not None else None
+
+    def wait(self, job_id, timeout):
+        """Block until the job's heatmap is no longer pending (or ``timeout`` seconds pass)."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None
+                remaining = deadline - time.monotonic()
+                if job.heatmap_status != 'pending' or remaining <= 0:
+                    return self.snapshot(job)
+                self._condition.wait(remaining)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counters)
+            stats['jobs'] = len(self._jobs)
+            stats['pending'] = sum(1 for job in self._jobs.values() if job.heatmap_status == 'pending')
+            stats['max_jobs'] = self.max_jobs
+            stats['ttl_s'] = self.ttl
+            return stats
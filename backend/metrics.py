@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    items = list(label_key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """In-process metrics rendered in the Prometheus text exposition format.
+
+    Histograms time stages and models, counters record what was chosen, and
+    gauge callbacks report the current state of caches and queues when
+    ``/metrics`` is scraped. Counter callbacks do the same for totals kept
+    by the components themselves, such as cache hits. Recording is a
+    dictionary update under a lock, so it is cheap enough for the request
+    path.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        # (metric type, callback) pairs called at scrape time
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def register_gauges(self, callback):
+        """Add ``callback()`` returning ``(name, labels, value)`` tuples, called at scrape time."""
+        self._callbacks.append(('gauge', callback))
+
+    def register_counters(self, callback):
+        """Like :meth:`register_gauges`, for values that only ever increase."""
+        self._callbacks.append(('counter', callback))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for key, histogram in sorted(series.items()):
+                    # counts are already cumulative: observe() bumps every bucket >= value
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{_format_labels(key, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(key, [("le", "+Inf")])} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram.count}')
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name, 'counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+
+        scraped = {}
+        for metric_type, callback in self._callbacks:
+            try:
+                for name, labels, value in callback():
+                    scraped.setdefault((name, metric_type), []).append((_label_key(labels), value))
+            except Exception:
+                continue
+        for (name, metric_type), series in sorted(scraped.items()):
+            self._header(lines, name, metric_type)
+            for key, value in series:
+                lines.append(f'{name}{_format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, metric_type):
+        if name in self._help:
+            lines.append(f'# HELP {name} {self._help[name]}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+
+# Shared by every module of the backend and served on /metrics
+METRICS = Metrics()
+METRICS.describe('lung_stage_seconds', 'Time spent in each pipeline stage')
+METRICS.describe('lung_model_seconds', 'Time spent running each model, including batching wait')
+METRICS.describe('lung_model_batch_seconds', 'Time spent executing each batch assembled by the scheduler')
+METRICS.describe('lung_scan_type_total', 'Images classified per detected scan type')
+METRICS.describe('lung_model_selected_total', 'Results per model whose prediction was returned')
+METRICS.describe('lung_cascade_total', 'Cascade decisions per scan type: first model accepted or escalated')
+METRICS.describe('lung_requests_total', 'HTTP requests per endpoint and status')
+METRICS.describe('lung_result_cache_events_total', 'Result cache hits per tier, misses, stores, evictions and expirations')
+METRICS.describe('lung_admission_events_total', 'Admission decisions per outcome: admitted at a level or rejected')
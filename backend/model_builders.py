@@ -0,0 +1,202 @@
+import logging
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Input, Dropout, BatchNormalization, Resizing, Rescaling, Layer
+from tensorflow.keras.applications import MobileNetV2, ResNet50, EfficientNetV2S, VGG16
+from tensorflow.keras.optimizers import Adam
+
+logger = logging.getLogger(__name__)
+
+INPUT_SHAPE = (224, 224, 3)
+MODELS_DIR = 'models'
+
+# Every model takes uint8 RGB images of any size: resizing to INPUT_SHAPE and
+# scaling to [0, 1] are layers of the model itself, so training, serving and
+# exported artifacts all preprocess identically
+IMAGE_INPUT_SHAPE = (None, None, 3)
+
+# Backbones are built without ImageNet weights by default: our fine-tuned
+# weights replace every layer anyway, so serving never touches the network or
+# the Keras cache. Pass weights='imagenet' only when training from scratch.
+
+def preprocessed_input():
+    """The uint8 image input of a model and the resized, rescaled tensor its backbone reads."""
+    image = Input(shape=IMAGE_INPUT_SHAPE, dtype='uint8', name='image')
+    # Nearest-neighbour resize of the uint8 pixels: only the 224x224 result is
+    # ever converted to float, not the full-resolution upload
+    x = Resizing(INPUT_SHAPE[0], INPUT_SHAPE[1], interpolation='nearest', dtype='uint8', name='resize')(image)
+    x = Rescaling(1.0 / 255, name='rescale')(x)
+    return image, x
+
+
+def fit_input_size(images):
+    """uint8 ``(n, H, W, 3)`` images resized exactly as the models' own resize layer does.
+
+    Lets images of different sizes be stacked into one batch without
+    changing what the models see.
+    """
+    resized = tf.image.resize(images, INPUT_SHAPE[:2], method='nearest')
+    return np.asarray(resized, dtype=np.uint8)
+
+
+# Define the scan type classifier model architecture
+def create_scan_classifier(weights=None):
+    _, input_tensor = preprocessed_input()
+    base_model = MobileNetV2(weights=weights, include_top=False, input_tensor=input_tensor)
+    x = base_model.output
+    x = GlobalAveragePooling2D()(x)
+    x = Dropout(0.3)(x)
+    output = Dense(1, activation='sigmoid')(x)
+    model = Model(inputs=base_model.input, outputs=output)
+    model.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
+    return model
+
+
+# Define CT model builder
+def build_ct_model(base_model, num_classes=4):
+    x = base_model.output
+    x = GlobalAveragePooling2D()(x)
+    x = BatchNormalization()(x)
+    x = Dropout(0.4)(x)
+    output = Dense(num_classes, activation='softmax')(x)
+    return Model(inputs=base_model.input, outputs=output)
+
+
+# Define X-ray model builder (binary classification)
+def build_xray_model(base_model):
+    x = base_model.output
+    x = GlobalAveragePooling2D()(x)
+    x = Dropout(0.3)(x)
+    output = Dense(1, activation='sigmoid')(x)
+    return Model(inputs=base_model.input, outputs=output)
+
+
+def create_ct_efficientnetv2s(weights=None):
+    eff_base = EfficientNetV2S(weights=weights, include_top=False, input_tensor=preprocessed_input()[1])
+    model = build_ct_model(eff_base, num_classes=4)
+    model.compile(optimizer=Adam(1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def create_ct_resnet50(weights=None):
+    resnet_base = ResNet50(weights=weights, include_top=False, input_tensor=preprocessed_input()[1])
+    model = build_ct_model(resnet_base, num_classes=4)
+    model.compile(optimizer=Adam(1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def create_xray_mobilenetv2(weights=None):
+    mobile_base = MobileNetV2(weights=weights, include_top=False, input_tensor=preprocessed_input()[1])
+    model = build_xray_model(mobile_base)
+    model.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def create_xray_vgg16(weights=None):
+    vgg_base = VGG16(weights=weights, include_top=False, input_tensor=preprocessed_input()[1])
+    model = build_xray_model(vgg_base)
+    model.compile(optimizer=Adam(1e-4), loss='binary_crossentropy', metrics=['accuracy'])
+    return model
+
+
+# Architecture builder and fine-tuned weights file of every served model
+MODEL_SPECS = {
+    'scan_classifier': (create_scan_classifier, 'ct_vs_xray_classifier.h5'),
+    'ct_efficientnetv2s': (create_ct_efficientnetv2s, 'ct_efficientnetv2s.h5'),
+    'ct_resnet50': (create_ct_resnet50, 'ct_resnet50.h5'),
+    'xray_mobilenetv2': (create_xray_mobilenetv2, 'xray_mobilenetv2.h5'),
+    'xray_vgg16': (create_xray_vgg16, 'xray_vgg16.h5'),
+}
+
+
+# How an ensemble combines its members' class probabilities
+ENSEMBLE_FUSIONS = ('mean', 'weighted', 'max-confidence')
+
+
+class EnsembleBranch(Layer):
+    """A member model of an ensemble, as a layer named after the model."""
+
+    def __init__(self, member, **kwargs):
+        super().__init__(**kwargs)
+        self.member = member
+
+    def call(self, images):
+        return self.member(images, training=False)
+
+
+class EnsembleFusion(Layer):
+    """Combine the members' outputs into ``(N, classes)`` probabilities.
+
+    Binary (sigmoid) outputs become ``[p, 1 - p]``. ``mean`` and
+    ``weighted`` average the members (``member_weights`` are normalised);
+    ``max-confidence`` takes, per image, the member whose top class is the
+    most probable.
+    """
+
+    def __init__(self, fusion='mean', member_weights=None, **kwargs):
+        super().__init__(**kwargs)
+        if fusion not in ENSEMBLE_FUSIONS:
+            raise ValueError(f"Unknown ensemble fusion: {fusion}")
+        self.fusion = fusion
+        self.member_weights = member_weights
+
+    def call(self, outputs):
+        probabilities = tf.stack([
+            tf.concat([output, 1 - output], axis=1) if output.shape[-1] == 1 else output
+            for output in outputs
+        ], axis=1)
+        if self.fusion == 'max-confidence':
+            best = tf.argmax(tf.reduce_max(probabilities, axis=2), axis=1)
+            return tf.gather(probabilities, best, axis=1, batch_dims=1)
+        weights = self.member_weights if self.fusion == 'weighted' and self.member_weights else [1.0] * len(outputs)
+        weights = tf.constant(weights, tf.float32) / sum(weights)
+        return tf.einsum('nmc,m->nc', probabilities, weights)
+
+
+def build_ensemble(members, fusion='mean', weights=None):
+    """One model running ``members`` (name -> loaded model) side by side on a shared input.
+
+    The image is resized once and every member reads it as a parallel
+    branch of the same graph. The outputs are each member's own output, in
+    order, followed by the fused class probabilities. ``weights`` maps
+    member names to their weight for the ``weighted`` fusion (default 1).
+    """
+    weights = weights or {}
+    image = Input(shape=IMAGE_INPUT_SHAPE, dtype='uint8', name='image')
+    resized = Resizing(INPUT_SHAPE[0], INPUT_SHAPE[1], interpolation='nearest', dtype='uint8', name='resize')(image)
+    heads = [EnsembleBranch(model, name=name)(resized) for name, model in members.items()]
+    fused = EnsembleFusion(fusion, [float(weights.get(name, 1.0)) for name in members], name='fusion')(heads)
+    return Model(inputs=image, outputs=heads + [fused], name='ensemble')
+
+
+def artifact_path(model_name, models_dir=MODELS_DIR):
+    """Path of the pre-serialized ``.keras`` artifact of ``model_name``."""
+    return os.path.join(models_dir, f'{model_name}.keras')
+
+
+def load_model(model_name, models_dir=MODELS_DIR):
+    """Load ``model_name`` for inference, without any network access.
+
+    Prefers the single ``.keras`` artifact written by ``export_models.py``;
+    otherwise builds the architecture without pretrained weights and loads
+    the fine-tuned ``.h5`` weights into it.
+    """
+    start = time.perf_counter()
+    path = artifact_path(model_name, models_dir)
+    model = None
+    if os.path.exists(path):
+        model = tf.keras.models.load_model(path, compile=False)
+        if model.input.dtype != tf.uint8:
+            logger.warning("%s predates the in-graph preprocessing, re-run export_models.py; "
+                           "loading the .h5 weights instead", path)
+            model = None
+    if model is None:
+        builder, weights_file = MODEL_SPECS[model_name]
+        path = os.path.join(models_dir, weights_file)
+        model = builder()
+        model.load_weights(path)
+    logger.info("Model %s loaded from %s in %.2fs", model_name, path, time.perf_counter() - start)
+    return model
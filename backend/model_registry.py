@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _LoadedModel:
+    def __init__(self, model, size_bytes, load_time):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.load_time = load_time
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    """Loads models on first use and keeps them within a memory budget.
+
+    ``loader(name)`` builds a model with its weights. Loaded models are kept
+    in least-recently-used order; when the estimated size of the resident
+    models exceeds ``memory_budget_mb`` the least recently used ones are
+    dropped (and ``on_evict(name)`` is called) until the pool fits again.
+    The model that was just requested is never evicted, nor is a model
+    pinned by another that is resident or being loaded (see :meth:`pin`).
+    A budget of 0 disables eviction.
+    """
+
+    def __init__(self, loader, model_names, memory_budget_mb=0, on_evict=None):
+        self.loader = loader
+        self.model_names = list(model_names)
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.on_evict = on_evict
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.model_names}
+        self._load_counts = {name: 0 for name in self.model_names}
+        self._evictions = 0
+        # name -> models whose weights it holds, and the models being loaded
+        self._pins = {}
+        self._loading = set()
+        self._warmup_names = []
+        self._warmup_done = threading.Event()
+        self._warmup_done.set()
+        self._warmup_errors = {}
+        self._warmup_seconds = None
+
+    @staticmethod
+    def estimate_size(model):
+        """Approximate resident size of a model's weights in bytes."""
+        if hasattr(model, 'size_bytes'):
+            return model.size_bytes
+        # Keras models hold float32 weights
+        return model.count_params() * 4
+
+    def get(self, name):
+        """Return model ``name``, loading it first if it is not resident."""
+        if name not in self._load_locks:
+            raise KeyError(f"Unknown model: {name}")
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None:
+                self._loaded.move_to_end(name)
+                entry.last_used = time.time()
+                return entry.model
+
+        # Only one thread loads a given model; the others wait for it
+        with self._load_locks[name]:
+            with self._lock:
+                entry = self._loaded.get(name)
+                if entry is not None:
+                    self._loaded.move_to_end(name)
+                    entry.last_used = time.time()
+                    return entry.model
+
+            with self._lock:
+                self._loading.add(name)
+            try:
+                start = time.perf_counter()
+                model = self.loader(name)
+                load_time = time.perf_counter() - start
+            finally:
+                with self._lock:
+                    self._loading.discard(name)
+            logger.info("Loaded model %s in %.2fs", name, load_time)
+
+            with self._lock:
+                self._loaded[name] = _LoadedModel(model, self.estimate_size(model), load_time)
+                self._load_counts[name] += 1
+                evicted = self._evict_over_budget(keep=name)
+        for evicted_name in evicted:
+            logger.info("Evicted model %s to stay within the memory budget", evicted_name)
+            if self.on_evict is not None:
+                self.on_evict(evicted_name)
+        return model
+
+    def pin(self, name, holder):
+        """Keep ``name`` resident while ``holder`` is resident or being loaded.
+
+        For a model built on the weights of another, e.g. a graph sharing
+        them: evicting ``name`` alone would not free its memory.
+        """
+        with self._lock:
+            self._pins.setdefault(name, set()).add(holder)
+
+    def _is_pinned(self, name):
+        return any(holder in self._loaded or holder in self._loading for holder in self._pins.get(name, ()))
+
+    def _evict_over_budget(self, keep):
+        evicted = []
+        if not self.memory_budget:
+            return evicted
+        while self._resident_bytes() > self.memory_budget:
+            victim = next((name for name in self._loaded if name != keep and not self._is_pinned(name)), None)
+            if victim is None:
+                break
+            del self._loaded[victim]
+            self._evictions += 1
+            evicted.append(victim)
+        return evicted
+
+    def _resident_bytes(self):
+        return sum(entry.size_bytes for entry in self._loaded.values())
+
+    def is_loaded(self, name):
+        with self._lock:
+            return name in self._loaded
+
+    def evict(self, name):
+        with self._lock:
+            removed = self._loaded.pop(name, None) is not None
+            if removed:
+                self._evictions += 1
+        if removed and self.on_evict is not None:
+            self.on_evict(name)
+        return removed
+
+    def warm_up(self, names, background=True, prepare=None):
+        """Eagerly load ``names`` (or ``['all']``); readiness is held until they are all resident.
+
+        ``prepare(name, model)`` is called on each model once it is loaded,
+        e.g. to trace its graphs with warm-up inputs, and readiness waits
+        for it too.
+        """
+        if 'all' in names:
+            names = self.model_names
+        names = [name for name in names if name in self._load_locks]
+        self._warmup_names = names
+        if not names:
+            return
+        self._warmup_done.clear()
+
+        def run():
+            start = time.perf_counter()
+            for name in names:
+                try:
+                    model = self.get(name)
+                    if prepare is not None:
+                        prepare(name, model)
+                except Exception as e:
+                    logger.error("Error warming up model %s: %s", name, e)
+                    self._warmup_errors[name] = str(e)
+            self._warmup_seconds = time.perf_counter() - start
+            logger.info("Warm-up of %d models done in %.2fs", len(names), self._warmup_seconds)
+            self._warmup_done.set()
+
+        if background:
+            threading.Thread(target=run, name="model-warmup", daemon=True).start()
+        else:
+            run()
+
+    def is_ready(self):
+        return self._warmup_done.is_set() and not self._warmup_errors
+
+    def status(self):
+        """Which models are resident, their size and load time, and the pool's budget."""
+        with self._lock:
+            models = {}
+            for name in self.model_names:
+                entry = self._loaded.get(name)
+                models[name] = {
+                    'loaded': entry is not None,
+                    'size_mb': round(entry.size_bytes / (1024 * 1024), 1) if entry else None,
+                    'load_time_s': round(entry.load_time, 3) if entry else None,
+                    'last_used': entry.last_used if entry else None,
+                    'load_count': self._load_counts[name],
+                }
+            return {
+                'ready': self.is_ready(),
+                'warmup': self._warmup_names,
+                'warmup_errors': dict(self._warmup_errors),
+                'warmup_time_s': round(self._warmup_seconds, 3) if self._warmup_seconds is not None else None,
+                'memory_budget_mb': self.memory_budget / (1024 * 1024),
+                'resident_mb': round(self._resident_bytes() / (1024 * 1024), 1),
+                'evictions': self._evictions,
+                'models': models,
+            }
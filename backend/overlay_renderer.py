@@ -0,0 +1,114 @@
+import threading
+
+import cv2
+import numpy as np
+
+# Extension -> (cv2.imencode extension, quality flag)
+ENCODINGS = {
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+    'png': ('.png', None),
+}
+
+
+def colormap_lut(colormap, alpha):
+    """256-entry OpenCV colormap (e.g. ``'jet'``) already scaled by ``alpha``, in BGR order.
+
+    Adding it to the scan with a saturating uint8 add gives exactly
+    ``clip(colormap * alpha + image)``, the blend the float version computed.
+    """
+    code = getattr(cv2, f'COLORMAP_{colormap.upper()}', None)
+    if code is None:
+        raise ValueError(f"Unknown colormap: {colormap}")
+    lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), code).reshape(256, 3)
+    lut = np.floor(lut.astype(np.float32) * alpha).astype(np.uint8)
+    # The overlay has always been blended as if the colormap were RGB; the
+    # renderer works in BGR, so swap its channels to keep the same colours
+    return np.ascontiguousarray(lut[:, ::-1])
+
+
+def fit_size(height, width, max_size):
+    """``(height, width)`` scaled down so the longest side is at most ``max_size`` (0 = no limit)."""
+    longest = max(height, width)
+    if not max_size or longest <= max_size:
+        return height, width
+    scale = max_size / longest
+    return max(1, round(height * scale)), max(1, round(width * scale))
+
+
+class OverlayRenderer:
+    """Blends Grad-CAM heatmaps onto scans and encodes them.
+
+    Every intermediate (resized scan, resized CAM, colour indices, overlay)
+    is written into scratch buffers kept per thread and reused across
+    requests, so rendering allocates no full-resolution arrays and no float
+    copy of the scan. Each variant in ``sizes`` (name -> maximum longest
+    side, 0 for the original size) is rendered from the same CAM, largest
+    first, each one downscaled from the previous one.
+    """
+
+    def __init__(self, alpha=0.4, colormap='jet', extension='jpg', quality=95,
+                 progressive=False, png_compression=3):
+        if extension not in ENCODINGS:
+            raise ValueError(f"Unknown heatmap format: {extension}")
+        self.lut = colormap_lut(colormap, alpha)
+        self.extension = extension
+        cv2_extension, quality_flag = ENCODINGS[extension]
+        self._cv2_extension = cv2_extension
+        if extension == 'png':
+            self._params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        else:
+            self._params = [quality_flag, quality]
+        if extension == 'jpg' and progressive:
+            self._params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        self._local = threading.local()
+
+    def _buffer(self, slot, shape, dtype):
+        buffers = self._local.__dict__.setdefault('buffers', {})
+        size = int(np.prod(shape))
+        flat = buffers.get((slot, dtype))
+        if flat is None or flat.size < size:
+            flat = buffers[(slot, dtype)] = np.empty(size, dtype)
+        return flat[:size].reshape(shape)
+
+    def blend(self, image, cam, height, width, slot=''):
+        """BGR overlay of ``cam`` on the RGB ``image`` at ``height`` x ``width``.
+
+        Returns ``(overlay, scan)`` where ``scan`` is ``image`` at that size.
+        Both may be views into this thread's scratch buffers, overwritten by
+        the next call for the same ``slot``.
+        """
+        if image.shape[:2] != (height, width):
+            image = cv2.resize(image, (width, height), dst=self._buffer(slot + 'scan', (height, width, 3), np.uint8),
+                               interpolation=cv2.INTER_AREA)
+        overlay = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self._buffer(slot + 'overlay', (height, width, 3), np.uint8))
+
+        cam_full = cv2.resize(np.asarray(cam, dtype=np.float32), (width, height),
+                              dst=self._buffer(slot + 'cam', (height, width), np.float32))
+        np.multiply(cam_full, 255, out=cam_full)
+        indices = self._buffer(slot + 'indices', (height, width), np.uint8)
+        np.copyto(indices, cam_full, casting='unsafe')
+        colours = self._buffer(slot + 'colours', (height, width, 3), np.uint8)
+        np.take(self.lut, indices, axis=0, out=colours, mode='clip')
+        return cv2.add(overlay, colours, dst=overlay), image
+
+    def encode(self, overlay):
+        success, encoded = cv2.imencode(self._cv2_extension, overlay, self._params)
+        if not success:
+            raise ValueError(f"{self.extension} encoding failed")
+        return encoded.tobytes()
+
+    @staticmethod
+    def plan(height, width, sizes):
+        """``[(name, (height, width))]`` of the variants in ``sizes``, largest first."""
+        variants = [(name, fit_size(height, width, max_size)) for name, max_size in sizes.items()]
+        return sorted(variants, key=lambda variant: variant[1], reverse=True)
+
+    def render(self, image, cam, sizes):
+        """Encoded overlays of ``cam`` on ``image`` for every ``name -> max_size`` in ``sizes``."""
+        encoded = {}
+        source = image
+        for slot, (name, (height, width)) in enumerate(self.plan(*image.shape[:2], sizes)):
+            overlay, source = self.blend(source, cam, height, width, slot=str(slot))
+            encoded[name] = self.encode(overlay)
+        return encoded
@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Content-addressed cache of ``process_image`` results.
+
+    Entries live in an in-process LRU of up to ``max_entries`` results and,
+    when ``disk_path`` is given, in a sqlite file of up to
+    ``max_disk_entries`` results that survives restarts. Entries older than
+    ``ttl_seconds`` are treated as misses. A ``max_entries`` of 0 disables
+    the cache.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, disk_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+        if disk_path and self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_created ON results (created)')
+            self._db.commit()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def make_key(content_hash, model_type):
+        return f'{content_hash}:{model_type}'
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, result = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return dict(result)
+                del self._memory[key]
+                self.counters['expirations'] += 1
+
+            if self._db is not None:
+                row = self._db.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if not self._expired(created):
+                        result = json.loads(value)
+                        self._store_memory(key, created, result)
+                        self.counters['disk_hits'] += 1
+                        return dict(result)
+                    self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self._db.commit()
+                    self.counters['expirations'] += 1
+
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, result):
+        if not self.enabled:
+            return
+        created = time.time()
+        with self._lock:
+            self._store_memory(key, created, dict(result))
+            self.counters['stores'] += 1
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)',
+                    (key, json.dumps(result), created)
+                )
+                # Keep only the newest max_disk_entries rows
+                self._db.execute(
+                    'DELETE FROM results WHERE key IN '
+                    '(SELECT key FROM results ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                    (self.max_disk_entries,)
+                )
+                self._db.commit()
+
+    def _store_memory(self, key, created, result):
+        self._memory[key] = (created, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self._memory)
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+            return stats
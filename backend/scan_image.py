@@ -0,0 +1,70 @@
+import hashlib
+import io
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+from model_builders import fit_input_size
+
+
+class ScanImage:
+    """An uploaded scan decoded exactly once.
+
+    Holds the full-resolution RGB array for the heatmap overlay and, as the
+    uint8 ``(1, 224, 224, 3)`` :attr:`pixels` batch, the input of every
+    model, so scan detection, classification and Grad-CAM share a single
+    decode and resize.
+    """
+
+    def __init__(self, pil_image):
+        self.original = np.asarray(pil_image.convert('RGB'))
+        self._pixels = None
+        self._content_hash = None
+
+    @property
+    def pixels(self):
+        """The scan as a one-image uint8 batch at the models' input size.
+
+        Resized once here, exactly as the models' own resize layer would,
+        so that uploads of any size share the scheduler's batches.
+        """
+        if self._pixels is None:
+            self._pixels = fit_input_size(self.original[np.newaxis])
+        return self._pixels
+
+    @classmethod
+    def from_bytes(cls, data):
+        try:
+            pil_image = Image.open(io.BytesIO(data))
+            pil_image.load()
+        except (UnidentifiedImageError, OSError) as e:
+            raise ValueError(f"Could not decode image: {str(e)}")
+        return cls(pil_image)
+
+    @classmethod
+    def from_array(cls, pixels):
+        """ScanImage of a uint8 grayscale ``(H, W)`` or RGB ``(H, W, 3)`` array."""
+        return cls(Image.fromarray(pixels))
+
+    @classmethod
+    def from_path(cls, img_path):
+        with open(img_path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    @property
+    def height(self):
+        return self.original.shape[0]
+
+    @property
+    def width(self):
+        return self.original.shape[1]
+
+    @property
+    def content_hash(self):
+        """SHA-256 of the decoded pixels, identical for byte-different files that decode to the same pixels."""
+        if self._content_hash is None:
+            digest = hashlib.sha256()
+            digest.update(str(self.original.shape).encode())
+            digest.update(self.original.tobytes())
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
@@ -0,0 +1,158 @@
+"""Production entry point: several gunicorn worker processes on one node.
+
+Run from the ``backend`` directory:
+
+    python serve.py --workers 4 --bind 0.0.0.0:5000
+
+The cores available to this process are split evenly between the workers:
+each worker's TensorFlow and TFLite thread pools are sized to its share and,
+with LUNG_PIN_WORKERS, the worker is pinned to those cores. Workers import
+the app after forking because TensorFlow's runtime does not survive a fork,
+so every worker loads its own copy of the models it serves and memory grows
+with the number of workers (see the README for measured figures).
+
+Models are served by Keras unless LUNG_INFERENCE_BACKENDS or ``--backend``
+select a TFLite file. ``--backend tflite-float16`` (or ``tflite-int8``)
+serves every model converted by convert_tflite.py from its memory-mapped
+file, whose pages the workers share; each interpreter still keeps its own
+packed copy of the weights, and Grad-CAM still loads the Keras model in
+every worker. Quantized models can predict differently from Keras.
+"""
+import argparse
+import glob
+import importlib
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+import config
+
+# Where convert_tflite.py writes; model_builders is not imported here since
+# TensorFlow must not be loaded before the fork
+MODELS_DIR = 'models'
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(cores, workers):
+    """Split ``cores`` into ``workers`` contiguous, near-equal slices."""
+    size, extra = divmod(len(cores), workers)
+    slices, start = [], 0
+    for slot in range(workers):
+        end = start + size + (1 if slot < extra else 0)
+        slices.append(cores[start:end] or cores)
+        start = end
+    return slices
+
+
+def size_thread_pools(threads_per_worker):
+    """Export per-worker thread counts; explicit LUNG_* settings take precedence."""
+    os.environ.setdefault('LUNG_TF_INTRA_OP_THREADS', str(threads_per_worker))
+    os.environ.setdefault('LUNG_TF_INTER_OP_THREADS', '2')
+    interpreters = max(1, config.TFLITE_INTERPRETERS)
+    os.environ.setdefault('LUNG_TFLITE_THREADS', str(max(1, threads_per_worker // interpreters)))
+    # numpy / OpenCV pools
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads_per_worker))
+    # Workers are forked from this process and inherit its already imported config
+    importlib.reload(config)
+
+
+BACKENDS = ('keras', 'tflite-float16', 'tflite-int8')
+
+
+def converted_models(quantization, models_dir=MODELS_DIR):
+    """Models with a ``<model>.<quantization>.tflite`` file from convert_tflite.py in ``models_dir``."""
+    suffix = f'.{quantization}.tflite'
+    return sorted(os.path.basename(path)[:-len(suffix)] for path in glob.glob(os.path.join(models_dir, '*' + suffix)))
+
+
+def select_backends(workers, backend='keras'):
+    """Export the worker count and, for a TFLite ``backend``, serve every converted model with it.
+
+    Explicit LUNG_INFERENCE_BACKENDS entries, "keras" included, take precedence.
+    """
+    os.environ['LUNG_WORKERS'] = str(workers)
+    if backend != 'keras':
+        backends = {name: backend for name in converted_models(backend.split('-', 1)[1])}
+        backends.update(config.INFERENCE_BACKENDS)
+        os.environ['LUNG_INFERENCE_BACKENDS'] = ','.join(f'{name}={value}' for name, value in backends.items())
+    importlib.reload(config)
+    tflite = sorted(name for name, value in config.INFERENCE_BACKENDS.items() if value != 'keras')
+    if tflite:
+        logger.warning("Served by TFLite instead of Keras, predictions may differ: %s",
+                       ', '.join(f'{name} ({config.INFERENCE_BACKENDS[name]})' for name in tflite))
+
+
+class ServerApplication(BaseApplication):
+    def __init__(self, options, core_slices):
+        self.options = options
+        self.core_slices = core_slices
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        if config.PIN_WORKERS and hasattr(os, 'sched_setaffinity'):
+            self.cfg.set('pre_fork', self.assign_slot)
+            self.cfg.set('post_fork', self.pin_worker)
+
+    def assign_slot(self, server, worker):
+        # Runs in the arbiter: a restarted worker takes over the free slot
+        used = {getattr(w, 'core_slot', None) for w in server.WORKERS.values()}
+        worker.core_slot = next(slot for slot in range(len(self.core_slices)) if slot not in used)
+
+    def pin_worker(self, server, worker):
+        cores = self.core_slices[worker.core_slot]
+        os.sched_setaffinity(0, cores)
+        server.log.info("Worker %s pinned to cores %s", worker.pid, cores)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def main(argv=None):
+    cores = available_cores()
+    parser = argparse.ArgumentParser(description="Serve the backend with several worker processes.")
+    parser.add_argument('--bind', default='0.0.0.0:5000')
+    parser.add_argument('--workers', type=int, default=config.WORKERS,
+                        help="worker processes (default: one per LUNG_WORKER_CORES cores)")
+    parser.add_argument('--threads', type=int, default=config.WORKER_THREADS,
+                        help="concurrent requests per worker")
+    parser.add_argument('--timeout', type=int, default=config.WORKER_TIMEOUT_S)
+    parser.add_argument('--backend', choices=BACKENDS, default='keras',
+                        help="serve every model converted by convert_tflite.py with this TFLite backend")
+    args = parser.parse_args(argv)
+
+    workers = args.workers or max(1, len(cores) // max(1, config.WORKER_CORES))
+    if workers > 1 and config.HEATMAP_STORE == 'memory':
+        parser.error("LUNG_HEATMAP_STORE=memory keeps heatmaps inside one worker; "
+                     "use disk or inline with several workers")
+    core_slices = partition_cores(cores, workers)
+    size_thread_pools(min(len(s) for s in core_slices))
+
+    logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+    select_backends(workers, args.backend)
+    logger.info("Starting %d workers x %d threads on %d cores", workers, args.threads, len(cores))
+    options = {
+        'bind': args.bind,
+        'workers': workers,
+        # Threads let concurrent requests reach the micro-batching scheduler together
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        # Model loading and warm-up happen in each worker after the fork
+        'preload_app': False,
+        'timeout': args.timeout,
+    }
+    ServerApplication(options, core_slices).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import queue
+
+import numpy as np
+import tensorflow as tf
+
+from model_builders import MODELS_DIR
+
+QUANTIZATIONS = ('float16', 'int8')
+
+
+def tflite_path(model_name, quantization, models_dir=MODELS_DIR):
+    return os.path.join(models_dir, f'{model_name}.{quantization}.tflite')
+
+
+def _float_resize(model):
+    """Copy of ``model`` whose ``resize`` layer works on float32 instead of uint8.
+
+    TFLite has no uint8 nearest-neighbour resize with half-pixel centers; on
+    float32 the result is the same.
+    """
+    def clone_layer(layer):
+        config = layer.get_config()
+        if layer.name == 'resize':
+            config['dtype'] = 'float32'
+        return layer.__class__.from_config(config)
+
+    clone = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+def convert_model(model, quantization, calibration_images=None):
+    """Convert a Keras model to a quantized TFLite flatbuffer.
+
+    ``float16`` halves the weights; ``int8`` quantizes weights and activations
+    using ``calibration_images`` (uint8 ``(H, W, 3)`` images) as the
+    representative dataset. The input stays a uint8 image of any size and
+    the output float32, so the served model is a drop-in replacement for
+    the Keras one.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(_float_resize(model))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        if calibration_images is None or len(calibration_images) == 0:
+            raise ValueError("int8 quantization needs a calibration set")
+
+        def representative_dataset():
+            for img in calibration_images:
+                yield [np.expand_dims(img, axis=0).astype(np.uint8)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+        ]
+    return converter.convert()
+
+
+class TFLiteModel:
+    """A TFLite model served from a pool of interpreters.
+
+    Each interpreter is used by one thread at a time, so up to
+    ``num_interpreters`` batches run concurrently, each on ``num_threads``
+    CPU threads. Exposes ``predict_on_batch`` like a Keras model so the
+    scheduler and registry can use either backend.
+    """
+
+    def __init__(self, model_path, num_interpreters=1, num_threads=None):
+        self.model_path = model_path
+        self.size_bytes = os.path.getsize(model_path)
+        self._pool = queue.Queue()
+        for _ in range(max(1, num_interpreters)):
+            interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+            interpreter.allocate_tensors()
+            self._pool.put(interpreter)
+
+    def predict_on_batch(self, batch):
+        interpreter = self._pool.get()
+        try:
+            input_details = interpreter.get_input_details()[0]
+            batch = np.asarray(batch, dtype=input_details['dtype'])
+            if tuple(input_details['shape']) != batch.shape:
+                interpreter.resize_tensor_input(input_details['index'], batch.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_details['index'], batch)
+            interpreter.invoke()
+            output_details = interpreter.get_output_details()[0]
+            return interpreter.get_tensor(output_details['index']).copy()
+        finally:
+            self._pool.put(interpreter)
+
+
+def load_tflite_model(model_name, quantization, models_dir=MODELS_DIR, num_interpreters=1, num_threads=None):
+    path = tflite_path(model_name, quantization, models_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} not found; create it with: python convert_tflite.py --models {model_name} "
+            f"--quantization {quantization}"
+        )
+    return TFLiteModel(path, num_interpreters=num_interpreters, num_threads=num_threads)
@@ -0,0 +1,299 @@
+"""Train and evaluate the served models with a tf.data input pipeline.
+
+Run from the ``backend`` directory. Images sit in one folder per class,
+as in the notebook's ``dataset/`` layout (``dataset/train/ct/<class>/...``);
+the scan classifier reads the ``ct`` and ``xray`` folders of a split.
+
+    python train.py fit --model ct_efficientnetv2s --train-dir dataset/train/ct --val-dir dataset/val/ct
+    python train.py eval --model ct_efficientnetv2s --data-dir dataset/test/ct
+    python train.py tfrecords --model ct_efficientnetv2s --data-dir dataset/train/ct --output-dir records/ct_train
+
+Models come from the same builders the server uses (MODEL_SPECS), so the
+uint8 input, resize and rescale layers are trained with the network and the
+fine-tuned weights are written to the file the server loads.
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from compiled_model import CompiledModel
+from convert_tflite import IMAGE_EXTENSIONS, MODEL_CLASSES, predicted_classes
+from export_models import export_model
+from model_builders import INPUT_SHAPE, MODEL_SPECS, MODELS_DIR, artifact_path, load_model
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Augmentation of the notebook's ImageDataGenerator (rotation 20 degrees,
+# zoom 0.2, shifts 0.1, horizontal flips, nearest fill), as layers running
+# in the input pipeline on whole batches
+AUGMENTATION = tf.keras.Sequential([
+    tf.keras.layers.RandomFlip('horizontal'),
+    tf.keras.layers.RandomRotation(20 / 360, fill_mode='nearest'),
+    tf.keras.layers.RandomZoom(0.2, fill_mode='nearest'),
+    tf.keras.layers.RandomTranslation(0.1, 0.1, fill_mode='nearest'),
+], name='augmentation')
+
+
+def _normalize(name):
+    return ' '.join(re.findall(r'[a-z0-9]+', name.lower()))
+
+
+def folder_class(folder, classes):
+    """Index of the class a folder is named after, or None.
+
+    Matches case-insensitively on the start of the name, so that e.g.
+    ``large.cell.carcinoma_left.hilum`` is ``Large Cell Carcinoma`` and
+    ``PNEUMONIA`` is ``pneumonia``.
+    """
+    folder = _normalize(folder)
+    for index, class_name in enumerate(classes):
+        if folder == _normalize(class_name) or folder.startswith(_normalize(class_name) + ' '):
+            return index
+    return None
+
+
+def labelled_images(data_dir, classes):
+    """``(paths, labels)`` of the images under ``data_dir``, labelled by their top-level folder."""
+    paths, labels = [], []
+    for folder in sorted(os.listdir(data_dir)):
+        if not os.path.isdir(os.path.join(data_dir, folder)):
+            continue
+        label = folder_class(folder, classes)
+        if label is None:
+            print(f"Skipping {os.path.join(data_dir, folder)}: not one of {classes}")
+            continue
+        for root, _, files in os.walk(os.path.join(data_dir, folder)):
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(root, filename))
+                    labels.append(label)
+    if not paths:
+        raise ValueError(f"No labelled images under {data_dir}")
+    return paths, labels
+
+
+def decode(data):
+    """Encoded PNG/JPEG bytes to a uint8 image at the models' input size.
+
+    Nearest-neighbour, like the models' own resize layer, so that batches
+    stack and the network sees the same pixels as in serving.
+    """
+    image = tf.io.decode_image(data, channels=3, expand_animations=False)
+    image = tf.image.resize(image, INPUT_SHAPE[:2], method='nearest')
+    return tf.cast(image, tf.uint8)
+
+
+def _augment(images, labels):
+    images = AUGMENTATION(tf.cast(images, tf.float32), training=True)
+    return tf.cast(tf.clip_by_value(tf.round(images), 0, 255), tf.uint8), labels
+
+
+def _target(labels, num_classes):
+    if num_classes == 2:
+        # Binary models output P(class 1)
+        return tf.cast(labels[..., tf.newaxis], tf.float32)
+    return tf.one_hot(labels, num_classes)
+
+
+def build_dataset(examples, num_classes, batch_size=32, training=False, cache=None, shuffle_buffer=1000):
+    """Batched ``(uint8 images, targets)`` from a dataset of ``(encoded bytes, label)``.
+
+    Decoding runs in parallel; decoded images are cached (in memory, or in
+    the ``cache`` file prefix) so later epochs skip decoding. Training data
+    is reshuffled every epoch and augmented per batch. Batches are
+    prefetched so the input pipeline runs ahead of the model.
+    """
+    dataset = examples.map(lambda data, label: (decode(data), label),
+                           num_parallel_calls=AUTOTUNE, deterministic=not training)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=training)
+    if training:
+        dataset = dataset.map(_augment, num_parallel_calls=AUTOTUNE, deterministic=False)
+    dataset = dataset.map(lambda images, labels: (images, _target(labels, num_classes)), num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def file_examples(paths, labels):
+    """``(encoded bytes, label)`` read from image files in parallel."""
+    examples = tf.data.Dataset.from_tensor_slices((paths, np.asarray(labels, np.int64)))
+    return examples.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=AUTOTUNE)
+
+
+# TFRecord shards hold the original encoded files, so nothing is re-encoded
+RECORD_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+def write_tfrecords(paths, labels, classes, output_dir, shards=8):
+    """Write the images as ``shards`` TFRecord files plus a ``classes.json`` naming the labels."""
+    os.makedirs(output_dir, exist_ok=True)
+    order = np.random.default_rng(0).permutation(len(paths))
+    shards = max(1, min(shards, len(paths)))
+    for shard in range(shards):
+        path = os.path.join(output_dir, f'data-{shard:05d}-of-{shards:05d}.tfrecord')
+        with tf.io.TFRecordWriter(path) as writer:
+            for i in order[shard::shards]:
+                with open(paths[i], 'rb') as f:
+                    feature = {
+                        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[f.read()])),
+                        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[labels[i]])),
+                    }
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+    with open(os.path.join(output_dir, 'classes.json'), 'w') as f:
+        json.dump({'classes': list(classes), 'images': len(paths), 'shards': shards}, f, indent=2)
+    return shards
+
+
+def record_examples(record_dir, classes, training=False):
+    """``(encoded bytes, label)`` read from the TFRecord shards of ``record_dir``, interleaved in parallel."""
+    with open(os.path.join(record_dir, 'classes.json')) as f:
+        metadata = json.load(f)
+    if metadata['classes'] != list(classes):
+        raise ValueError(f"{record_dir} holds classes {metadata['classes']}, the model predicts {list(classes)}")
+    files = tf.data.Dataset.list_files(os.path.join(record_dir, '*.tfrecord'), shuffle=training)
+    records = files.interleave(tf.data.TFRecordDataset, cycle_length=AUTOTUNE,
+                               num_parallel_calls=AUTOTUNE, deterministic=not training)
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, RECORD_FEATURES)
+        return example['image'], example['label']
+
+    return records.map(parse, num_parallel_calls=AUTOTUNE), metadata['images']
+
+
+def examples_from(directory, classes, training=False):
+    """``(examples, count)`` of a folder of class subfolders or of TFRecord shards."""
+    if os.path.exists(os.path.join(directory, 'classes.json')):
+        return record_examples(directory, classes, training)
+    paths, labels = labelled_images(directory, classes)
+    return file_examples(paths, labels), len(paths)
+
+
+def fit(args):
+    classes = MODEL_CLASSES[args.model]
+    builder, weights_file = MODEL_SPECS[args.model]
+    train_examples, train_count = examples_from(args.train_dir, classes, training=True)
+    train = build_dataset(train_examples, len(classes), args.batch_size, training=True,
+                          cache=args.cache, shuffle_buffer=min(args.shuffle_buffer, train_count))
+    val = None
+    if args.val_dir:
+        val_examples, _ = examples_from(args.val_dir, classes)
+        val = build_dataset(val_examples, len(classes), args.batch_size, cache='')
+
+    model = builder(weights=None if args.weights == 'none' else args.weights)
+    if args.init_weights:
+        model.load_weights(args.init_weights)
+    os.makedirs(args.models_dir, exist_ok=True)
+    weights_path = os.path.join(args.models_dir, weights_file)
+    checkpoint = tf.keras.callbacks.ModelCheckpoint(
+        weights_path, monitor='val_accuracy' if val is not None else 'accuracy',
+        save_best_only=True, save_weights_only=True,
+    )
+    print(f"Training {args.model} on {train_count} images ({classes})")
+    start = time.perf_counter()
+    history = model.fit(train, validation_data=val, epochs=args.epochs, callbacks=[checkpoint])
+    elapsed = time.perf_counter() - start
+    print(f"Trained in {elapsed:.1f}s ({train_count * args.epochs / elapsed:.1f} images/s); "
+          f"best weights in {weights_path}")
+    # The server prefers the .keras artifact, which would still hold the old weights
+    if os.path.exists(artifact_path(args.model, args.models_dir)):
+        export_model(args.model, args.models_dir)
+    return history
+
+
+def evaluate(args):
+    """Batch-score a held-out set with the served weights; accuracy and images/sec."""
+    classes = MODEL_CLASSES[args.model]
+    examples, count = examples_from(args.data_dir, classes)
+    dataset = build_dataset(examples, len(classes), args.batch_size)
+    model = CompiledModel(load_model(args.model, args.models_dir), batch_sizes=[args.batch_size])
+    model.warm_up()
+
+    predictions, truth = [], []
+    start = time.perf_counter()
+    for images, targets in dataset:
+        predictions.append(predicted_classes(model.predict_on_batch(images)))
+        truth.append(predicted_classes(targets.numpy()))
+    elapsed = time.perf_counter() - start
+    predictions, truth = np.concatenate(predictions), np.concatenate(truth)
+
+    confusion = np.zeros((len(classes), len(classes)), dtype=int)
+    np.add.at(confusion, (truth, predictions), 1)
+    report = {
+        'model': args.model,
+        'images': int(count),
+        'batch_size': args.batch_size,
+        'seconds': round(elapsed, 3),
+        'images_per_sec': round(count / elapsed, 1),
+        'accuracy': float(np.mean(predictions == truth)),
+        'per_class_accuracy': {
+            name: float(confusion[i, i] / confusion[i].sum()) if confusion[i].sum() else None
+            for i, name in enumerate(classes)
+        },
+        'confusion_matrix': {'classes': list(classes), 'rows_true_columns_predicted': confusion.tolist()},
+    }
+    print(f"{args.model}: accuracy {report['accuracy']:.4f} on {count} images, "
+          f"{report['images_per_sec']} images/s (decode + model, batch {args.batch_size})")
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+    return report
+
+
+def tfrecords(args):
+    classes = MODEL_CLASSES[args.model]
+    paths, labels = labelled_images(args.data_dir, classes)
+    shards = write_tfrecords(paths, labels, classes, args.output_dir, args.shards)
+    print(f"Wrote {len(paths)} images in {shards} shards to {args.output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and evaluate the served models with a tf.data pipeline.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fit_parser = commands.add_parser('fit', help="Fine-tune a model and write its weights where the server loads them")
+    fit_parser.add_argument('--model', required=True, choices=list(MODEL_SPECS))
+    fit_parser.add_argument('--train-dir', required=True, help="Class subfolders, or TFRecord shards")
+    fit_parser.add_argument('--val-dir', help="Class subfolders, or TFRecord shards")
+    fit_parser.add_argument('--epochs', type=int, default=10)
+    fit_parser.add_argument('--batch-size', type=int, default=32)
+    fit_parser.add_argument('--shuffle-buffer', type=int, default=1000)
+    fit_parser.add_argument('--cache', default='',
+                            help="File prefix for the decoded-image cache (default: in memory)")
+    fit_parser.add_argument('--weights', default='imagenet', help="Backbone initialisation: imagenet or none")
+    fit_parser.add_argument('--init-weights', help="Weights file to start from, e.g. the currently served .h5")
+    fit_parser.add_argument('--models-dir', default=MODELS_DIR)
+    fit_parser.set_defaults(run=fit)
+
+    eval_parser = commands.add_parser('eval', help="Score a held-out set with the served weights")
+    eval_parser.add_argument('--model', required=True, choices=list(MODEL_SPECS))
+    eval_parser.add_argument('--data-dir', required=True, help="Class subfolders, or TFRecord shards")
+    eval_parser.add_argument('--batch-size', type=int, default=64)
+    eval_parser.add_argument('--models-dir', default=MODELS_DIR)
+    eval_parser.add_argument('--report', default='eval_report.json')
+    eval_parser.set_defaults(run=evaluate)
+
+    records_parser = commands.add_parser('tfrecords', help="Convert a folder of class subfolders to TFRecord shards")
+    records_parser.add_argument('--model', required=True, choices=list(MODEL_SPECS),
+                                help="Model whose classes label the images")
+    records_parser.add_argument('--data-dir', required=True)
+    records_parser.add_argument('--output-dir', required=True)
+    records_parser.add_argument('--shards', type=int, default=8)
+    records_parser.set_defaults(run=tfrecords)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -88,6 +88,19 @@ const Lung = () => {
     maxFiles: 1
   });
 
+  // The diagnosis is shown as soon as it is known; the heatmap is pushed once rendered
+  const followHeatmap = (jobId: string, message: ChatMessage) => {
+    const events = new EventSource(`http://localhost:5000/jobs/${jobId}/events`);
+    events.addEventListener('heatmap', (event) => {
+      const job = JSON.parse((event as MessageEvent).data);
+      if (job.visualization) {
+        setChatHistory(prev => prev.map(m => (m === message ? { ...m, visualization: job.visualization } : m)));
+      }
+      events.close();
+    });
+    events.onerror = () => events.close();
+  };
+
   const handleAnalyze = async () => {
     try {
       if (!selectedFile) {
@@ -101,7 +114,7 @@ const Lung = () => {
       formData.append('scan_mode', scanMode);
       formData.append('model_type', modelType);
 
-      const response = await fetch('http://localhost:5000/predict', {
+      const response = await fetch('http://localhost:5000/jobs', {
         method: 'POST',
         body: formData,
         headers: {
@@ -134,8 +147,8 @@ const Lung = () => {
       }
 
       // Add the analysis result to chat history with visualization
-      const chatMessage = {
-        role: 'assistant' as const,
+      const chatMessage: ChatMessage = {
+        role: 'assistant',
         content: resultMessage,
         timestamp: new Date(),
         visualization: data.visualization
@@ -143,6 +156,9 @@ const Lung = () => {
       console.log('Chat message with visualization:', chatMessage); // Debug log
 
       setChatHistory(prev => [...prev, chatMessage]);
+      if (data.job_id && !data.visualization) {
+        followHeatmap(data.job_id, chatMessage);
+      }
     } catch (error) {
       console.error('Error during analysis:', error);
       setError(error instanceof Error ? error.message : 'Failed to analyze image');
@@ -698,7 +714,7 @@ For specific medical advice, always recommend consulting a healthcare provider.`
         <DialogContent>
           {selectedVisualization && (
             <img
-              src={`http://localhost:5000${selectedVisualization}`}
+              src={selectedVisualization.startsWith('data:') ? selectedVisualization : `http://localhost:5000${selectedVisualization}`}
               alt="Model Visualization"
               style={{ width: '100%', height: 'auto' }}
             />
@@ -490,7 +490,7 @@ const PredictionPage = () => {
         <DialogContent sx={{ p: 3 }}>
           {selectedVisualization && (
             <img
-              src={`http://localhost:5000${selectedVisualization}`}
+              src={selectedVisualization.startsWith('data:') ? selectedVisualization : `http://localhost:5000${selectedVisualization}`}
               alt="Model Visualization"
               style={{ 
                 width: '100%', 